@@ -1,7 +1,194 @@
 -- Executed by Postgres on first run
+--
+-- Raw samples are report-by-exception (each row holds until the device's next
+-- one), partitioned by UTC day. Rollups are time-weighted and kept current by
+-- a statement trigger on every insert/COPY batch. historian_maintain() is run
+-- by the logger to create partitions ahead of time and drop expired ones.
+
 CREATE TABLE IF NOT EXISTS process_metrics (
-  ts TIMESTAMPTZ DEFAULT now(),
+  ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+  device TEXT,
   conveyor_run BOOLEAN,
   emergency_ok BOOLEAN,
   quality_score INT
+) PARTITION BY RANGE (ts);
+
+-- catches rows outside the prepared range until the next maintenance run
+CREATE TABLE IF NOT EXISTS process_metrics_default
+  PARTITION OF process_metrics DEFAULT;
+
+CREATE INDEX IF NOT EXISTS process_metrics_device_ts
+  ON process_metrics (device, ts);
+
+CREATE TABLE IF NOT EXISTS process_metrics_1m (
+  bucket TIMESTAMPTZ NOT NULL,
+  device TEXT NOT NULL,
+  quality_min INT,
+  quality_max INT,
+  quality_avg DOUBLE PRECISION,
+  run_secs DOUBLE PRECISION NOT NULL,
+  covered_secs DOUBLE PRECISION NOT NULL,
+  run_fraction DOUBLE PRECISION
+    GENERATED ALWAYS AS (run_secs / NULLIF(covered_secs, 0)) STORED,
+  PRIMARY KEY (device, bucket)
 );
+
+CREATE TABLE IF NOT EXISTS process_metrics_1h (LIKE process_metrics_1m INCLUDING ALL);
+
+-- How long a device's row holds without a successor, written by the logger
+-- from each device's heartbeat and poll interval.
+CREATE TABLE IF NOT EXISTS historian_devices (
+  device TEXT PRIMARY KEY,
+  hold INTERVAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS historian_rollup_state (
+  id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+  upto TIMESTAMPTZ
+);
+INSERT INTO historian_rollup_state DEFAULT VALUES ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION process_metrics_create_day(day DATE)
+RETURNS void LANGUAGE plpgsql AS $$
+DECLARE
+  lo TIMESTAMPTZ := day::timestamp AT TIME ZONE 'UTC';
+  hi TIMESTAMPTZ := (day + 1)::timestamp AT TIME ZONE 'UTC';
+  part TEXT := format('process_metrics_%s', to_char(day, 'YYYYMMDD'));
+BEGIN
+  IF to_regclass(part) IS NOT NULL THEN
+    RETURN;
+  END IF;
+  -- rows that landed in the default partition must move before the range
+  -- can be attached
+  CREATE TEMP TABLE _moved (LIKE process_metrics) ON COMMIT DROP;
+  WITH m AS (
+    DELETE FROM process_metrics_default WHERE ts >= lo AND ts < hi RETURNING *
+  )
+  INSERT INTO _moved SELECT * FROM m;
+  EXECUTE format(
+    'CREATE TABLE %I PARTITION OF process_metrics FOR VALUES FROM (%L) TO (%L)',
+    part, lo, hi
+  );
+  INSERT INTO process_metrics SELECT * FROM _moved;
+  DROP TABLE _moved;
+END $$;
+
+-- Time-weighted rollups for buckets overlapping [lo, hi). A row's value holds
+-- until the device's next row, at most the device's hold from
+-- historian_devices (`default_hold` for unknown devices), so gaps while the logger
+-- is down are not counted.
+CREATE OR REPLACE FUNCTION historian_rollup(
+  lo TIMESTAMPTZ, hi TIMESTAMPTZ, default_hold INTERVAL DEFAULT '5 minutes'
+) RETURNS void LANGUAGE plpgsql AS $$
+DECLARE
+  max_hold INTERVAL := GREATEST(
+    default_hold, (SELECT max(d.hold) FROM historian_devices d)
+  );
+BEGIN
+  lo := date_trunc('minute', lo);
+  INSERT INTO process_metrics_1m AS r
+    (bucket, device, quality_min, quality_max, quality_avg, run_secs, covered_secs)
+  WITH seg AS (
+    SELECT m.device, m.ts AS t0,
+           LEAST(COALESCE(lead(m.ts) OVER w, hi),
+                 m.ts + COALESCE(d.hold, default_hold)) AS t1,
+           m.conveyor_run, m.quality_score
+    FROM process_metrics m
+    LEFT JOIN historian_devices d ON d.device = m.device
+    WHERE m.ts >= lo - max_hold AND m.ts < hi
+    WINDOW w AS (PARTITION BY m.device ORDER BY m.ts)
+  ), piece AS (
+    SELECT s.device, b AS bucket, s.conveyor_run, s.quality_score,
+           extract(epoch FROM LEAST(s.t1, b + interval '1 minute')
+                              - GREATEST(s.t0, b)) AS secs
+    FROM seg s,
+         generate_series(date_trunc('minute', s.t0), s.t1, interval '1 minute') b
+    WHERE s.t1 > s.t0
+  )
+  SELECT bucket, device, min(quality_score), max(quality_score),
+         sum(quality_score * secs) / NULLIF(sum(secs), 0),
+         coalesce(sum(secs) FILTER (WHERE conveyor_run), 0),
+         sum(secs)
+  FROM piece
+  WHERE secs > 0 AND bucket >= lo AND device IS NOT NULL
+  GROUP BY bucket, device
+  ON CONFLICT (device, bucket) DO UPDATE SET
+    quality_min = excluded.quality_min,
+    quality_max = excluded.quality_max,
+    quality_avg = excluded.quality_avg,
+    run_secs = excluded.run_secs,
+    covered_secs = excluded.covered_secs;
+
+  lo := date_trunc('hour', lo);
+  INSERT INTO process_metrics_1h AS r
+    (bucket, device, quality_min, quality_max, quality_avg, run_secs, covered_secs)
+  SELECT date_trunc('hour', bucket), device, min(quality_min), max(quality_max),
+         sum(quality_avg * covered_secs) / NULLIF(sum(covered_secs), 0),
+         sum(run_secs), sum(covered_secs)
+  FROM process_metrics_1m
+  WHERE bucket >= lo AND bucket < hi
+  GROUP BY 1, 2
+  ON CONFLICT (device, bucket) DO UPDATE SET
+    quality_min = excluded.quality_min,
+    quality_max = excluded.quality_max,
+    quality_avg = excluded.quality_avg,
+    run_secs = excluded.run_secs,
+    covered_secs = excluded.covered_secs;
+END $$;
+
+-- A new row also ends the previous row's hold, which the last refresh counted
+-- up to its own `upto`; start there if that is earlier than the batch.
+CREATE OR REPLACE FUNCTION process_metrics_rollup_trg()
+RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+  lo TIMESTAMPTZ;
+  hi TIMESTAMPTZ;
+  prev TIMESTAMPTZ;
+BEGIN
+  SELECT min(ts), max(ts) INTO lo, hi FROM new_rows;
+  IF lo IS NULL THEN
+    RETURN NULL;
+  END IF;
+  hi := GREATEST(now(), hi + interval '1 microsecond');
+  SELECT upto INTO prev FROM historian_rollup_state FOR UPDATE;
+  PERFORM historian_rollup(LEAST(lo, prev), hi);
+  UPDATE historian_rollup_state SET upto = GREATEST(upto, hi);
+  RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS process_metrics_rollup ON process_metrics;
+CREATE TRIGGER process_metrics_rollup
+  AFTER INSERT ON process_metrics
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION process_metrics_rollup_trg();
+
+-- Creates today's partition and `days_ahead` more, drops raw partitions that
+-- ended more than `raw_keep` ago and minute rollups older than `minute_keep`.
+-- Hourly rollups are kept.
+CREATE OR REPLACE FUNCTION historian_maintain(
+  raw_keep INTERVAL DEFAULT '30 days',
+  minute_keep INTERVAL DEFAULT '90 days',
+  days_ahead INT DEFAULT 7
+) RETURNS void LANGUAGE plpgsql AS $$
+DECLARE
+  today DATE := (now() AT TIME ZONE 'UTC')::date;
+  cutoff DATE := ((now() - raw_keep) AT TIME ZONE 'UTC')::date;
+  p RECORD;
+BEGIN
+  FOR i IN 0..days_ahead LOOP
+    PERFORM process_metrics_create_day(today + i);
+  END LOOP;
+  FOR p IN
+    SELECT c.relname FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'process_metrics'::regclass
+      AND c.relname ~ '^process_metrics_[0-9]{8}$'
+      AND to_date(right(c.relname, 8), 'YYYYMMDD') < cutoff
+  LOOP
+    EXECUTE format('DROP TABLE %I', p.relname);
+  END LOOP;
+  DELETE FROM process_metrics_default WHERE ts < cutoff::timestamp AT TIME ZONE 'UTC';
+  DELETE FROM process_metrics_1m WHERE bucket < now() - minute_keep;
+END $$;
+
+SELECT historian_maintain();
@@ -1,28 +1,427 @@
-import os, time
+import os, time, json, queue, random, socket, struct, asyncio, threading
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
 import psycopg
-from pyModbusTCP.client import ModbusClient
 
-DB = psycopg.connect(
+DB_ARGS = dict(
     host=os.getenv("DB_HOST", "historiandb"),
     dbname=os.getenv("DB_NAME", "histdb"),
     user=os.getenv("DB_USER", "hist"),
     password=os.getenv("DB_PASS", "histpass"),
+    connect_timeout=int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
 )
 PLC_HOST = os.getenv("PLC_HOST", "plc1")
 PLC_PORT = int(os.getenv("PLC_PORT", "502"))
+POLL_SECS = float(os.getenv("POLL_SECS", "2"))
+DEBUG = os.getenv("DEBUG", "0") == "1"
+# JSON list of {"name", "host", "port", "unit", "interval", "map", "deadband",
+# "heartbeat"}; without it the single PLC_HOST/PLC_PORT device is polled
+DEVICES_FILE = os.getenv("DEVICES_FILE", "")
+# Report by exception: a row is written when a boolean flips, a numeric tag
+# moves more than its deadband from the last *written* value, or HEARTBEAT_SECS
+# pass without a row. Each row holds until the device's next one.
+HEARTBEAT_SECS = float(os.getenv("HEARTBEAT_SECS", "60"))
+QUALITY_DEADBAND = int(os.getenv("QUALITY_DEADBAND", "0"))
 
-c = ModbusClient(host=PLC_HOST, port=PLC_PORT, auto_open=True, auto_close=True)
-
-print("[hist] logger started")
-while True:
-    regs = c.read_holding_registers(300, 4) or [0, 0, 0, 0]
-    conveyor = bool(regs[0])
-    estop = bool(regs[1])
-    quality = (regs[2] << 16) | regs[3]
-    with DB.cursor() as cur:
-        cur.execute(
-            "INSERT INTO process_metrics(conveyor_run, emergency_ok, quality_score) VALUES (%s,%s,%s)",
-            (conveyor, estop, quality),
+# column -> [first register, word count]; multi-word values are big-endian
+DEFAULT_MAP = {
+    "conveyor_run": [300, 1],
+    "emergency_ok": [301, 1],
+    "quality_score": [302, 2],
+}
+COLUMNS = ("conveyor_run", "emergency_ok", "quality_score")
+BOOL_COLUMNS = ("conveyor_run", "emergency_ok")
+
+# Modbus sessions stay open between polls; a dropped one is re-established
+# with exponential backoff; polls that fail are skipped, not stored
+MB_CONNECT_TIMEOUT = float(os.getenv("MB_CONNECT_TIMEOUT", "3"))
+MB_REQUEST_TIMEOUT = float(os.getenv("MB_REQUEST_TIMEOUT", "1"))
+MB_KEEPALIVE_SECS = int(os.getenv("MB_KEEPALIVE_SECS", "30"))
+MB_BACKOFF_MIN = float(os.getenv("MB_BACKOFF_MIN", "0.5"))
+MB_BACKOFF_MAX = float(os.getenv("MB_BACKOFF_MAX", "30"))
+# register ranges closer than this are fetched in one read (max 125 words)
+MB_MERGE_GAP = int(os.getenv("MB_MERGE_GAP", "8"))
+MB_MAX_READ = 125
+
+# a batch is flushed once it holds BATCH_ROWS samples or is BATCH_SECS old
+BATCH_ROWS = int(os.getenv("BATCH_ROWS", "500"))
+BATCH_SECS = float(os.getenv("BATCH_SECS", "10"))
+# rows that could not be written are appended here and replayed first on the
+# next successful flush, so a Postgres outage costs latency, not samples
+SPOOL_PATH = Path(os.getenv("SPOOL_PATH", "/app/spool/process_metrics.tsv"))
+RETRY_SECS = float(os.getenv("DB_RETRY_SECS", "5"))
+# rows kept in memory while neither the database nor the spool takes them
+UNSAVED_MAX_ROWS = int(os.getenv("UNSAVED_MAX_ROWS", "100000"))
+# historian_maintain() (init.sql) pre-creates daily partitions and drops
+# expired ones; run on connect and every MAINTAIN_SECS
+MAINTAIN_SECS = float(os.getenv("MAINTAIN_SECS", "3600"))
+RAW_KEEP_DAYS = int(os.getenv("RAW_KEEP_DAYS", "30"))
+MINUTE_KEEP_DAYS = int(os.getenv("MINUTE_KEEP_DAYS", "90"))
+
+COPY_SQL = (
+    "COPY process_metrics (ts, device, conveyor_run, emergency_ok, quality_score) "
+    "FROM STDIN"
+)
+
+SAMPLES: "queue.Queue[tuple]" = queue.Queue()
+
+
+class Writer:
+    def __init__(self):
+        self.conn: psycopg.Connection | None = None
+        self.retry_at = 0.0
+        self.maintain_at = 0.0
+        self.managed = False  # schema from init.sql with maintenance/rollups
+        self.warned_unmanaged = False
+        self.unsaved: deque[tuple] = deque(maxlen=UNSAVED_MAX_ROWS)
+
+    def _connect(self) -> psycopg.Connection:
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg.connect(**DB_ARGS)
+            # databases initialised before the device column existed
+            self.conn.execute(
+                "ALTER TABLE process_metrics ADD COLUMN IF NOT EXISTS device TEXT"
+            )
+            self.managed = self.conn.execute(
+                "SELECT to_regproc('historian_maintain') IS NOT NULL "
+                "AND to_regclass('historian_devices') IS NOT NULL"
+            ).fetchone()[0]
+            if self.managed:
+                self._register_devices()
+            elif not self.warned_unmanaged:
+                self.warned_unmanaged = True
+                print(
+                    "[hist] database predates the partitioned schema in "
+                    "init.sql: no partition upkeep, retention or rollups",
+                    flush=True,
+                )
+            self.conn.commit()
+            self.maintain_at = 0.0
+        return self.conn
+
+    def _register_devices(self) -> None:
+        # a row holds until the next one: at most a heartbeat plus poll jitter
+        with self.conn.cursor() as cur:
+            cur.executemany(
+                "INSERT INTO historian_devices (device, hold) "
+                "VALUES (%s, make_interval(secs => %s)) "
+                "ON CONFLICT (device) DO UPDATE SET hold = excluded.hold",
+                [(d["name"], d["heartbeat"] + 2 * d["interval"]) for d in DEVICES],
+            )
+
+    def _maintain(self) -> None:
+        if not self.managed or time.monotonic() < self.maintain_at:
+            return
+        self.maintain_at = time.monotonic() + MAINTAIN_SECS
+        try:
+            self.conn.execute(
+                "SELECT historian_maintain(make_interval(days => %s), "
+                "make_interval(days => %s))",
+                (RAW_KEEP_DAYS, MINUTE_KEEP_DAYS),
+            )
+            self.conn.commit()
+        except psycopg.Error as e:
+            self.conn.rollback()
+            print(f"[hist] maintenance failed: {e}", flush=True)
+
+    def _copy(self, rows) -> None:
+        conn = self._connect()
+        with conn.cursor() as cur:
+            with cur.copy(COPY_SQL) as cp:
+                for row in rows:
+                    cp.write_row(row)
+        conn.commit()
+
+    def _spool(self, rows: list[tuple]) -> None:
+        SPOOL_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with SPOOL_PATH.open("a") as f:
+            for ts, device, conveyor, estop, quality in rows:
+                f.write(
+                    f"{ts.isoformat()}\t{device}\t{conveyor:d}\t{estop:d}\t{quality}\n"
+                )
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _parse_spooled(line: str) -> tuple:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) == 4:  # written before the device column existed
+            fields.insert(1, PLC_HOST)
+        ts, device, conveyor, estop, quality = fields
+        if conveyor not in ("0", "1") or estop not in ("0", "1"):
+            raise ValueError("bad boolean")
+        return (
+            datetime.fromisoformat(ts),
+            device,
+            conveyor == "1",
+            estop == "1",
+            int(quality),
+        )
+
+    def _replay_spool(self) -> None:
+        if not SPOOL_PATH.exists():
+            return
+        rows, bad = [], 0
+        with SPOOL_PATH.open(errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(self._parse_spooled(line))
+                except ValueError:
+                    bad += 1  # e.g. a line cut short by a crash mid-append
+        if rows:
+            self._copy(rows)
+        SPOOL_PATH.unlink()
+        print(
+            f"[hist] replayed {len(rows)} spooled rows, skipped {bad} malformed",
+            flush=True,
         )
-        DB.commit()
-    time.sleep(2)
+
+    def flush(self, rows: list[tuple]) -> None:
+        if self.unsaved:
+            rows = [*self.unsaved, *rows]
+            self.unsaved.clear()
+        if not rows:
+            return
+        if time.monotonic() >= self.retry_at:
+            try:
+                self._replay_spool()
+                self._copy(rows)
+                self._maintain()
+                return
+            except (psycopg.Error, OSError) as e:
+                print(f"[hist] db write failed, spooling: {e}", flush=True)
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+                self.retry_at = time.monotonic() + RETRY_SECS
+        try:
+            self._spool(rows)
+        except OSError as e:
+            dropped = max(0, len(rows) - UNSAVED_MAX_ROWS)
+            print(
+                f"[hist] spool write failed, holding rows in memory "
+                f"({dropped} dropped): {e}",
+                flush=True,
+            )
+            self.unsaved.extend(rows)
+
+    def run(self) -> None:
+        batch: list[tuple] = []
+        deadline = None
+        while True:
+            timeout = (
+                None if deadline is None else max(0.0, deadline - time.monotonic())
+            )
+            try:
+                batch.append(SAMPLES.get(timeout=timeout))
+                if deadline is None:
+                    deadline = time.monotonic() + BATCH_SECS
+            except queue.Empty:
+                pass
+            if len(batch) >= BATCH_ROWS or (
+                deadline is not None and time.monotonic() >= deadline
+            ):
+                try:
+                    self.flush(batch)
+                except Exception as e:
+                    # never let the writer thread die: the pollers keep queueing
+                    print(f"[hist] flush error, batch lost: {e!r}", flush=True)
+                batch, deadline = [], None
+
+
+class ModbusError(Exception):
+    pass
+
+
+class ModbusSession:
+    """Persistent Modbus/TCP connection to one device, one request at a time."""
+
+    def __init__(self, host: str, port: int, unit: int):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.tid = 0
+        self.lock = asyncio.Lock()
+        self.backoff = MB_BACKOFF_MIN
+        self.retry_at = 0.0
+
+    async def _open(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop.time() < self.retry_at:
+            raise ConnectionError("backing off")
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), MB_CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError):
+            self.retry_at = loop.time() + self.backoff * random.uniform(0.5, 1.0)
+            self.backoff = min(self.backoff * 2, MB_BACKOFF_MAX)
+            raise
+        sock = self.writer.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, MB_KEEPALIVE_SECS)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        self.backoff = MB_BACKOFF_MIN
+        print(f"[hist] connected to {self.host}:{self.port}", flush=True)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _request(self, pdu: bytes) -> bytes:
+        self.tid = (self.tid + 1) & 0xFFFF
+        self.writer.write(
+            struct.pack(">HHHB", self.tid, 0, len(pdu) + 1, self.unit) + pdu
+        )
+        await self.writer.drain()
+        tid, _, length, _ = struct.unpack(">HHHB", await self.reader.readexactly(7))
+        if not 2 < length <= 254:  # unit id + function code + data, MBAP limit
+            raise ConnectionError(f"bad MBAP length {length}")
+        body = await self.reader.readexactly(length - 1)
+        if tid != self.tid:
+            raise ConnectionError(f"transaction id {tid} != {self.tid}")
+        return body
+
+    async def read_holding(self, address: int, count: int) -> list[int]:
+        async with self.lock:
+            if self.writer is None:
+                # outside the request deadline so MB_CONNECT_TIMEOUT and the
+                # backoff in _open apply to hanging connects too
+                await self._open()
+            try:
+                body = await asyncio.wait_for(
+                    self._request(struct.pack(">BHH", 3, address, count)),
+                    MB_REQUEST_TIMEOUT,
+                )
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                # a cancelled read leaves the stream mid-frame: start over
+                self.close()
+                raise
+        if body[0] == 0x83:
+            raise ModbusError(f"exception {body[1]} reading {address}+{count}")
+        if body[0] != 3 or body[1] != 2 * count or len(body) != 2 + 2 * count:
+            raise ModbusError(
+                f"malformed reply to {address}+{count}: fc={body[0]} "
+                f"bytes={body[1]} len={len(body)}"
+            )
+        return list(struct.unpack(f">{count}H", body[2:]))
+
+
+def read_blocks(regmap: dict) -> list[tuple[int, int]]:
+    """Merge the map's register ranges into as few reads as possible."""
+    spans = sorted((addr, addr + words) for addr, words in regmap.values())
+    blocks: list[list[int]] = []
+    for lo, hi in spans:
+        if (
+            blocks
+            and lo - blocks[-1][1] <= MB_MERGE_GAP
+            and max(hi, blocks[-1][1]) - blocks[-1][0] <= MB_MAX_READ
+        ):
+            blocks[-1][1] = max(hi, blocks[-1][1])
+        else:
+            blocks.append([lo, hi])
+    return [(lo, hi - lo) for lo, hi in blocks]
+
+
+def load_devices() -> list[dict]:
+    if DEVICES_FILE:
+        devices = json.loads(Path(DEVICES_FILE).read_text())
+    else:
+        devices = [{"name": PLC_HOST, "host": PLC_HOST, "port": PLC_PORT}]
+    for d in devices:
+        d.setdefault("name", d["host"])
+        d.setdefault("port", 502)
+        d.setdefault("unit", 1)
+        d.setdefault("interval", POLL_SECS)
+        d.setdefault("heartbeat", HEARTBEAT_SECS)
+        d["deadband"] = {"quality_score": QUALITY_DEADBAND, **d.get("deadband", {})}
+        d["map"] = {**DEFAULT_MAP, **d.get("map", {})}
+    return devices
+
+
+def changed(deadband: dict, last: list | None, row: list) -> bool:
+    if last is None:
+        return True
+    for col, old, new in zip(COLUMNS, last, row):
+        if col in BOOL_COLUMNS:
+            if old != new:
+                return True
+        elif abs(new - old) > deadband.get(col, 0):
+            return True
+    return False
+
+
+def decode(regmap: dict, regs: dict[int, int]) -> list:
+    out = []
+    for col in COLUMNS:
+        addr, words = regmap[col]
+        v = 0
+        for a in range(addr, addr + words):
+            v = (v << 16) | regs.get(a, 0)
+        out.append(bool(v) if col in BOOL_COLUMNS else v)
+    return out
+
+
+async def poll_device(dev: dict) -> None:
+    session = ModbusSession(dev["host"], dev["port"], dev["unit"])
+    regmap = dev["map"]
+    blocks = read_blocks(regmap)
+    loop = asyncio.get_running_loop()
+    next_at = loop.time()
+    last: list | None = None
+    last_at = 0.0
+    while True:
+        regs: dict[int, int] = {}
+        row = None
+        for lo, count in blocks:
+            try:
+                words = await session.read_holding(lo, count)
+            except Exception as e:
+                if DEBUG:
+                    print(f"[hist] {dev['name']}: read failed: {e!r}", flush=True)
+                break
+            regs.update(zip(range(lo, lo + count), words))
+        else:
+            row = decode(regmap, regs)
+        now = loop.time()
+        # a failed read stores nothing rather than zeros for the missing
+        # registers; the last row's hold expires on its own
+        if row is not None and (
+            changed(dev["deadband"], last, row) or now - last_at >= dev["heartbeat"]
+        ):
+            SAMPLES.put((datetime.now(timezone.utc), dev["name"], *row))
+            last, last_at = row, now
+        next_at += dev["interval"]
+        if next_at < now:
+            next_at = now  # slow device: don't burst to catch up
+        await asyncio.sleep(next_at - now)
+
+
+async def supervise(dev: dict) -> None:
+    # one misbehaving device must not end the others' polling
+    while True:
+        try:
+            await poll_device(dev)
+        except Exception as e:
+            print(
+                f"[hist] {dev['name']}: poller crashed, restarting: {e!r}", flush=True
+            )
+            await asyncio.sleep(dev["interval"])
+
+
+async def poll_all(devices: list[dict]) -> None:
+    await asyncio.gather(*(supervise(d) for d in devices))
+
+
+DEVICES = load_devices()
+threading.Thread(target=Writer().run, daemon=True).start()
+print(f"[hist] logger started, {len(DEVICES)} device(s)")
+asyncio.run(poll_all(DEVICES))
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import asyncio
 import ctypes
 import os
 import sys
@@ -6,13 +7,15 @@ import time
 import json
 import base64
 import threading
-import socketserver
+import queue
 import sqlite3
-from pathlib import Path
 from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 from typing import Tuple, List
 
-from pyModbusTCP.server import ModbusServer
+from pyModbusTCP.server import DataBank, ModbusServer
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.exceptions import InvalidSignature
@@ -29,6 +32,22 @@ LIB.plc_compromised.restype = ctypes.c_int
 LIB.get_conveyor_run.restype = ctypes.c_uint8
 LIB.get_emergency_ok.restype = ctypes.c_uint8
 LIB.get_quality_score.restype = ctypes.c_uint32
+
+
+class PlcStatus(ctypes.Structure):
+    """Mirror of plc_status_t in plc_shared.h."""
+
+    _fields_ = [
+        ("compromised", ctypes.c_int32),
+        ("conveyor_run", ctypes.c_uint8),
+        ("emergency_ok", ctypes.c_uint8),
+        ("reserved", ctypes.c_uint16),
+        ("quality_score", ctypes.c_uint32),
+    ]
+
+
+LIB.plc_get_status.argtypes = [ctypes.POINTER(PlcStatus)]
+LIB.plc_get_status.restype = None
 LIB.plc_reset_state()
 
 DEBUG = os.getenv("DEBUG", "0") == "1"
@@ -36,6 +55,11 @@ DEBUG = os.getenv("DEBUG", "0") == "1"
 MGMT_ALLOWLIST = {
     ip.strip() for ip in os.getenv("MGMT_ALLOWLIST", "").split(",") if ip.strip()
 }
+MGMT_IDLE_SECS = float(os.getenv("MGMT_IDLE_SECS", "30"))
+MGMT_MAX_REQUESTS = int(os.getenv("MGMT_MAX_REQUESTS", "1000"))
+MGMT_MAX_LINE = 65536
+MGMT_VERIFY_WORKERS = int(os.getenv("MGMT_VERIFY_WORKERS", "4"))
+MGMT_VERIFY_QUEUE = int(os.getenv("MGMT_VERIFY_QUEUE", "256"))
 
 pub_key = None
 pem_txt = os.getenv("CHECKER_PUB_PEM", "").strip()
@@ -53,16 +77,32 @@ class SQLiteFlagStore:
     """
     Stores every flag write (history) and can return the latest flag per flag_id,
     or all latest flags across all flag_ids.
+
+    The `latest` table holds one row per flag_id and is kept current by a trigger
+    on `flags`, so reads never scan the history.
+
+    Writes are queued to a single writer thread that commits them in groups
+    (every `commit_ms` or `commit_rows` rows); put() returns a Future that
+    resolves once the row's transaction is committed. Reads use one
+    connection per calling thread.
     """
 
-    def __init__(self, db_path: str = "/data/flags.db"):
+    def __init__(
+        self,
+        db_path: str = "/data/flags.db",
+        commit_ms: float = 5.0,
+        commit_rows: int = 256,
+    ):
         self.db_path = db_path
+        self.commit_secs = commit_ms / 1000.0
+        self.commit_rows = commit_rows
         Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
         self._conn = sqlite3.connect(
             self.db_path, check_same_thread=False, isolation_level=None
         )
         self._conn.execute("PRAGMA journal_mode=WAL;")
-        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        # group commit amortizes the fsync, so commits can be fully durable
+        self._conn.execute("PRAGMA synchronous=FULL;")
         self._conn.execute(
             """
             CREATE TABLE IF NOT EXISTS flags (
@@ -76,48 +116,188 @@ class SQLiteFlagStore:
         self._conn.execute(
             "CREATE INDEX IF NOT EXISTS idx_flags_fid_created ON flags(fid, created_at DESC);"
         )
-
-    def put(self, fid: str, flag: str) -> None:
-        self._conn.execute("INSERT INTO flags(fid, flag) VALUES (?, ?);", (fid, flag))
-
-    def get_latest(self, fid: str) -> str:
-        cur = self._conn.execute(
-            "SELECT flag FROM flags WHERE fid = ? ORDER BY id DESC LIMIT 1;", (fid,)
-        )
-        row = cur.fetchone()
-        return row[0] if row else ""
-
-    def get_all_latest(self) -> List[str]:
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS latest (
+              fid     TEXT PRIMARY KEY,
+              flag_id INTEGER NOT NULL,
+              flag    TEXT NOT NULL
+            );
         """
-        Return the latest flag for each fid.
+        )
+        self._conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_flags_latest AFTER INSERT ON flags
+            BEGIN
+              INSERT INTO latest(fid, flag_id, flag) VALUES (NEW.fid, NEW.id, NEW.flag)
+              ON CONFLICT(fid) DO UPDATE
+                SET flag_id = excluded.flag_id, flag = excluded.flag
+                WHERE excluded.flag_id > latest.flag_id;
+            END;
         """
-        cur = self._conn.execute(
+        )
+        # backfill databases created before the latest table existed
+        self._conn.execute(
             """
-            SELECT f.flag
+            INSERT OR IGNORE INTO latest(fid, flag_id, flag)
+            SELECT f.fid, f.id, f.flag
             FROM flags f
             JOIN (
               SELECT fid, MAX(id) AS max_id
               FROM flags
               GROUP BY fid
-            ) latest ON latest.max_id = f.id;
+            ) l ON l.max_id = f.id
+            WHERE NOT EXISTS (SELECT 1 FROM latest);
         """
         )
+        self._blob_cache: dict[tuple, bytes] = {}
+        self._local = threading.local()
+        self._queue: queue.Queue = queue.Queue()
+        threading.Thread(target=self._writer, name="flag-writer", daemon=True).start()
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None)
+            conn.execute("PRAGMA query_only=1;")
+            self._local.conn = conn
+        return conn
+
+    def _writer(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.commit_secs
+            while len(batch) < self.commit_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # callers that cancelled while queued are dropped here
+            batch = [b for b in batch if b[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._insert(batch)
+                results = [None] * len(batch)
+            except Exception:
+                # one bad row must not fail the others: retry them one by one
+                results = []
+                for row in batch:
+                    try:
+                        self._insert([row])
+                        results.append(None)
+                    except Exception as e:
+                        results.append(e)
+            # replace rather than clear: a concurrent reader keeps filling the old dict
+            self._blob_cache = {}
+            for (_, _, fut), err in zip(batch, results):
+                if err is None:
+                    fut.set_result(None)
+                else:
+                    fut.set_exception(err)
+
+    def _insert(self, rows: list) -> None:
+        try:
+            self._conn.execute("BEGIN IMMEDIATE;")
+            self._conn.executemany(
+                "INSERT INTO flags(fid, flag) VALUES (?, ?);",
+                [(fid, flag) for fid, flag, _ in rows],
+            )
+            self._conn.execute("COMMIT;")
+        except Exception:
+            try:
+                self._conn.execute("ROLLBACK;")
+            except sqlite3.Error:
+                pass
+            raise
+
+    def put(self, fid: str, flag: str) -> Future:
+        if not isinstance(fid, str) or not isinstance(flag, str):
+            raise TypeError("flag_id and flag must be strings")
+        fut: Future = Future()
+        self._queue.put((fid, flag, fut))
+        return fut
+
+    def get_latest(self, fid: str) -> str:
+        cur = self._reader().execute("SELECT flag FROM latest WHERE fid = ?;", (fid,))
+        row = cur.fetchone()
+        return row[0] if row else ""
+
+    def get_all_latest(self) -> List[str]:
+        """
+        Return the latest flag for each fid.
+        """
+        cur = self._reader().execute("SELECT flag FROM latest ORDER BY fid;")
         return [r[0] for r in cur.fetchall()]
 
     def concat_all_latest(self, sep: str = "\n", max_bytes: int | None = None) -> bytes:
         """
         Join all latest flags with `sep`. If max_bytes is set, truncate safely.
+        Cached until the next put().
         """
-        data = sep.join(self.get_all_latest()).encode()
-        return data[:max_bytes] if max_bytes is not None else data
+        cache = self._blob_cache
+        key = (sep, max_bytes)
+        data = cache.get(key)
+        if data is None:
+            data = sep.join(self.get_all_latest()).encode()
+            data = data[:max_bytes] if max_bytes is not None else data
+            cache[key] = data
+        return data
 
 
 FLAGS_DB_PATH = os.getenv("FLAGS_DB", "/data/flags.db")
-FLAG_STORE = SQLiteFlagStore(FLAGS_DB_PATH)
+FLAGS_COMMIT_MS = float(os.getenv("FLAGS_COMMIT_MS", "5"))
+FLAGS_COMMIT_ROWS = int(os.getenv("FLAGS_COMMIT_ROWS", "256"))
+FLAG_STORE = SQLiteFlagStore(FLAGS_DB_PATH, FLAGS_COMMIT_MS, FLAGS_COMMIT_ROWS)
 
 # ------------------------- Auth / anti-replay ---------------------------------
 
-NONCES: deque[str] = deque(maxlen=4096)
+TS_WINDOW_SECS = 120
+NONCE_BUCKET_SECS = 10
+MAX_NONCES = int(os.getenv("MAX_NONCES", "1000000"))
+
+
+class NonceCache:
+    """
+    Replay cache: hash lookup plus expiry buckets aligned to the ts window.
+
+    A nonce is kept until its ts + window has passed, after which precheck()
+    rejects it on ts alone. When MAX_NONCES live entries exist, new nonces are
+    refused rather than evicting ones still inside the window.
+    """
+
+    def __init__(self, window: int, bucket_secs: int, max_entries: int):
+        self.window = window
+        self.bucket_secs = bucket_secs
+        self.max_entries = max_entries
+        self._seen: set[str] = set()
+        self._buckets: dict[int, list[str]] = {}
+        self._lock = threading.Lock()
+
+    def _expire(self, now: int) -> None:
+        for b in [b for b in self._buckets if (b + 1) * self.bucket_secs <= now]:
+            self._seen.difference_update(self._buckets.pop(b))
+
+    def __contains__(self, nonce: str) -> bool:
+        with self._lock:
+            return nonce in self._seen
+
+    def add(self, nonce: str, ts: int, now: int) -> bool:
+        """Record nonce; False if it was already seen or the cache is full."""
+        with self._lock:
+            self._expire(now)
+            if nonce in self._seen or len(self._seen) >= self.max_entries:
+                return False
+            self._seen.add(nonce)
+            b = (ts + self.window) // self.bucket_secs
+            self._buckets.setdefault(b, []).append(nonce)
+            return True
+
+
+NONCES = NonceCache(TS_WINDOW_SECS, NONCE_BUCKET_SECS, MAX_NONCES)
 
 
 def canon_v1(op: str, flag_id: str, flag: str | None, ts: int, nonce: str) -> bytes:
@@ -125,9 +305,13 @@ def canon_v1(op: str, flag_id: str, flag: str | None, ts: int, nonce: str) -> by
     return f"{op}|{flag_id}|{flag_s}|{ts}|{nonce}".encode()
 
 
-def verify(msg: dict) -> bool:
+def precheck(msg: dict) -> tuple | None:
+    """
+    Cheap request checks (fields, ts window, replay). Returns the arguments
+    for check_sig() plus (nonce, ts, now) for the final replay record.
+    """
     if pub_key is None:
-        return False
+        return None
     try:
         op = msg.get("op")
         fid = msg.get("flag_id")
@@ -137,17 +321,23 @@ def verify(msg: dict) -> bool:
         fl = msg.get("flag") if op == "put" else None
 
         if not (op in ("put", "get") and fid and nonce and sig_b64):
-            return False
+            return None
 
         now = int(time.time())
-        if abs(now - ts) > 120:
-            return False
+        if abs(now - ts) > TS_WINDOW_SECS:
+            return None
         if nonce in NONCES:
-            return False
+            return None
 
         sig = base64.b64decode(sig_b64)
-        pub_key.verify(sig, canon_v1(op, fid, fl, ts, nonce), ec.ECDSA(hashes.SHA256()))
-        NONCES.append(nonce)
+        return sig, canon_v1(op, fid, fl, ts, nonce), nonce, ts, now
+    except Exception:
+        return None
+
+
+def check_sig(sig: bytes, data: bytes) -> bool:
+    try:
+        pub_key.verify(sig, data, ec.ECDSA(hashes.SHA256()))
         return True
     except InvalidSignature:
         return False
@@ -155,144 +345,527 @@ def verify(msg: dict) -> bool:
         return False
 
 
-class Handler(socketserver.StreamRequestHandler):
-    def handle(self):
+class MgmtServer:
+    """
+    asyncio mgmt API on :9000. Newline-delimited JSON requests are parsed and
+    pre-checked on the loop; ECDSA verification and flag reads run in a bounded
+    thread pool, and puts go to the store's group-commit writer. Each
+    connection is served in request order, so clients may pipeline; it closes
+    after MGMT_IDLE_SECS idle or MGMT_MAX_REQUESTS requests.
+    """
+
+    def __init__(self, store: SQLiteFlagStore):
+        self.store = store
+        self.pool = ThreadPoolExecutor(
+            max_workers=MGMT_VERIFY_WORKERS, thread_name_prefix="mgmt"
+        )
+
+    async def serve(self, host: str, port: int) -> None:
+        self.verify_slots = asyncio.Semaphore(MGMT_VERIFY_QUEUE)
+        srv = await asyncio.start_server(
+            self._client, host, port, limit=MGMT_MAX_LINE, backlog=4096
+        )
+        async with srv:
+            await srv.serve_forever()
+
+    async def _client(self, reader, writer) -> None:
         try:
-            if MGMT_ALLOWLIST and (self.client_address[0] not in MGMT_ALLOWLIST):
-                self._send_error("ip_denied")
+            peer = writer.get_extra_info("peername") or ("", 0)
+            if MGMT_ALLOWLIST and (peer[0] not in MGMT_ALLOWLIST):
+                await self._send(writer, {"ok": False, "err": "ip_denied"})
                 return
 
-            line = self.rfile.readline(65536)
-            if not line:
-                self._send_error("empty_request")
-                return
+            for n in range(MGMT_MAX_REQUESTS):
+                try:
+                    line = await asyncio.wait_for(reader.readline(), MGMT_IDLE_SECS)
+                except (asyncio.TimeoutError, ConnectionError):
+                    return
+                except ValueError:
+                    # oversized request: the rest of the stream can't be framed
+                    await self._send(writer, {"ok": False, "err": "bad_json"})
+                    return
+                if not line:
+                    if n == 0:
+                        await self._send(writer, {"ok": False, "err": "empty_request"})
+                    return
+                if not line.strip():
+                    continue
+                await self._send(writer, await self._handle_line(line))
+        except Exception as e:
+            if DEBUG:
+                print(f"[plc] mgmt connection error: {e}", flush=True)
+        finally:
+            writer.close()
 
+    async def _handle_line(self, line: bytes) -> dict:
+        try:
             try:
                 msg = json.loads(line.decode("utf-8"))
             except (json.JSONDecodeError, UnicodeDecodeError):
-                self._send_error("bad_json")
-                return
-
-            if not verify(msg):
-                self._send_error("auth")
-                return
+                return {"ok": False, "err": "bad_json"}
+
+            pre = precheck(msg) if isinstance(msg, dict) else None
+            if pre is None:
+                return {"ok": False, "err": "auth"}
+            sig, data, nonce, ts, now = pre
+            loop = asyncio.get_running_loop()
+            async with self.verify_slots:
+                ok = await loop.run_in_executor(self.pool, check_sig, sig, data)
+            if not ok or not NONCES.add(nonce, ts, now):
+                return {"ok": False, "err": "auth"}
 
             op = msg.get("op")
             fid = msg.get("flag_id")
             if not op or not fid:
-                self._send_error("missing_fields")
-                return
+                return {"ok": False, "err": "missing_fields"}
 
             if op == "put":
-                self._handle_put(msg, fid)
+                try:
+                    fut = self.store.put(fid, msg.get("flag", ""))
+                except TypeError:
+                    return {"ok": False, "err": "bad_fields"}
+                await asyncio.wrap_future(fut)
+                return {"ok": True}
             elif op == "get":
-                self._handle_get(fid)
-            else:
-                self._send_error("bad_op")
+                flag = await loop.run_in_executor(self.pool, self.store.get_latest, fid)
+                return {"ok": True, "flag": flag}
+            return {"ok": False, "err": "bad_op"}
 
         except Exception as e:
             if DEBUG:
                 print(f"[plc] Handler error: {e}", flush=True)
-            self._send_error("internal_error")
-
-    def _handle_put(self, msg: dict, fid: str) -> None:
-        flag = msg.get("flag", "")
-        FLAG_STORE.put(fid, flag)
-        self._send_success()
-
-    def _handle_get(self, fid: str) -> None:
-        latest_for_id = FLAG_STORE.get_latest(fid)
-        self._send_json({"ok": True, "flag": latest_for_id})
+            return {"ok": False, "err": "internal_error"}
 
-    def _send_error(self, error: str) -> None:
-        self._send_json({"ok": False, "err": error})
-
-    def _send_success(self) -> None:
-        self._send_json({"ok": True})
-
-    def _send_json(self, data: dict) -> None:
+    async def _send(self, writer, data: dict) -> None:
         try:
-            response = json.dumps(data).encode("utf-8") + b"\n"
-            self.wfile.write(response)
+            writer.write(json.dumps(data).encode("utf-8") + b"\n")
+            await writer.drain()
         except Exception as e:
             if DEBUG:
                 print(f"[plc] Failed to send response: {e}", flush=True)
 
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    daemon_threads = True
-    allow_reuse_address = True
+mgmt_server = MgmtServer(FLAG_STORE)
+threading.Thread(
+    target=asyncio.run, args=(mgmt_server.serve("0.0.0.0", 9000),), daemon=True
+).start()
+print("[plc] mgmt API on :9000 (ECDSA-verified)")
+
+# ------------------------- Metrics ---------------------------------------------
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LOOP_BUDGET_SECS = float(os.getenv("LOOP_BUDGET_MS", "200")) / 1000.0
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+class Histogram:
+    def __init__(self, name: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.n = 0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, secs: float) -> None:
+        i = 0
+        while i < len(self.buckets) and secs > self.buckets[i]:
+            i += 1
+        with self.lock:
+            self.counts[i] += 1
+            self.total += secs
+            self.n += 1
+            if secs > self.max:
+                self.max = secs
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile, capped at max."""
+        with self.lock:
+            target = q * self.n
+            acc = 0
+            for i, c in enumerate(self.counts):
+                acc += c
+                if c and acc >= target:
+                    if i < len(self.buckets):
+                        return min(self.buckets[i], self.max)
+                    return self.max
+            return 0.0
+
+    def render(self) -> list[str]:
+        with self.lock:
+            counts, total, n = list(self.counts), self.total, self.n
+        out = [f"# TYPE plc_{self.name}_seconds histogram"]
+        acc = 0
+        for b, c in zip(self.buckets, counts):
+            acc += c
+            out.append(f'plc_{self.name}_seconds_bucket{{le="{b}"}} {acc}')
+        out.append(f'plc_{self.name}_seconds_bucket{{le="+Inf"}} {n}')
+        out.append(f"plc_{self.name}_seconds_sum {total:.6f}")
+        out.append(f"plc_{self.name}_seconds_count {n}")
+        return out
+
+
+class Metrics:
+    def __init__(self):
+        # register write -> process_production_order returned
+        self.order_latency = Histogram("order_latency")
+        self.order_decode = Histogram("order_decode")
+        self.order_exec = Histogram("order_exec")
+        self.flag_fetch = Histogram("flag_fetch")
+        self.status_publish = Histogram("status_publish")
+        self.worker_loop = Histogram("worker_loop")
+        self.orders_processed = 0
+        self.fetches_served = 0
+        self.loop_overruns = 0
+
+    def histograms(self) -> list[Histogram]:
+        return [
+            self.order_latency,
+            self.order_decode,
+            self.order_exec,
+            self.flag_fetch,
+            self.status_publish,
+            self.worker_loop,
+        ]
+
+    def registers(self) -> list[int]:
+        """Read-only block at REG_METRICS_BASE, 32-bit values as hi/lo pairs."""
+        vals = [
+            self.orders_processed,
+            self.fetches_served,
+            self.loop_overruns,
+            int(self.order_latency.quantile(0.5) * 1e6),
+            int(self.order_latency.quantile(0.99) * 1e6),
+            int(self.order_latency.max * 1e6),
+        ]
+        out = []
+        for v in vals:
+            v &= 0xFFFFFFFF
+            out += [(v >> 16) & 0xFFFF, v & 0xFFFF]
+        return out
+
+    def render(self) -> str:
+        lines = [
+            "# TYPE plc_orders_processed_total counter",
+            f"plc_orders_processed_total {self.orders_processed}",
+            "# TYPE plc_fetches_served_total counter",
+            f"plc_fetches_served_total {self.fetches_served}",
+            "# TYPE plc_loop_overruns_total counter",
+            f"plc_loop_overruns_total {self.loop_overruns}",
+            "# TYPE plc_orders_dropped_total counter",
+            f"plc_orders_dropped_total {order_drops}",
+        ]
+        for h in self.histograms():
+            lines += h.render()
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
 
 
-mgmt_server = ThreadedTCPServer(("0.0.0.0", 9000), Handler)
-threading.Thread(target=mgmt_server.serve_forever, daemon=True).start()
-print("[plc] mgmt API on :9000 (ECDSA-verified)")
+if METRICS_PORT:
+    metrics_server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), MetricsHandler)
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    print(f"[plc] metrics on :{METRICS_PORT}/metrics")
+
+# ------------------------- Modbus register handling ---------------------------
+
+REG_ORDER_LEN = 99
+REG_ORDER_DATA = 100
+ORDER_DATA_WORDS = 100
+REG_ORDER_TRIGGER = 200
+REG_FETCH_TRIGGER = 210
+
+# Order ring. A producer writes slot (head % ORDER_SLOTS) at ORDER_RING_BASE
+# (length word + ORDER_DATA_WORDS data words, same encoding as 99/100..199),
+# then increments REG_ORDER_HEAD. The PLC advances REG_ORDER_TAIL as it
+# drains; producers must keep head - tail <= ORDER_SLOTS, and writes that would
+# move the head backwards are refused. Orders written via
+# the legacy 99/100..199 + 200=1 path are copied into an internal FIFO the
+# moment 200 is written, and 200 reads back 0 once the copy is queued.
+REG_ORDER_HEAD = 220
+REG_ORDER_TAIL = 221
+REG_ORDER_DEPTH = 222
+REG_ORDER_DROPS = 223
+REG_STATUS_BASE = 300  # conveyor, estop, quality hi/lo, ..., 310 compromised
+STATUS_WORDS = 11
+REG_METRICS_BASE = 500  # 12 words, see Metrics.registers()
+METRICS_WORDS = 12
+# PLC-owned [start, end) ranges: clients may read them, writes are refused
+READ_ONLY_REGS = (
+    (REG_ORDER_TAIL, REG_ORDER_DROPS + 1),
+    (REG_STATUS_BASE, REG_STATUS_BASE + STATUS_WORDS),
+    (REG_METRICS_BASE, REG_METRICS_BASE + METRICS_WORDS),
+)
+READ_ONLY_COILS = ((0, 2),)  # conveyor, estop mirrors
+ORDER_RING_BASE = 1000
+ORDER_SLOT_WORDS = 1 + ORDER_DATA_WORDS
+ORDER_SLOTS = int(os.getenv("ORDER_SLOTS", "16"))
+if ORDER_SLOTS < 1 or 0x10000 % ORDER_SLOTS:
+    raise SystemExit("[plc] ORDER_SLOTS must be a power of two")
+if ORDER_RING_BASE + ORDER_SLOTS * ORDER_SLOT_WORDS > 0x10000:
+    raise SystemExit("[plc] ORDER_SLOTS too large for the register space")
+
+TRIGGER = threading.Event()
+LEGACY_ORDERS: deque[tuple[float, bytes]] = deque()
+# arrival time of each ring order not yet drained, appended as head advances
+RING_STAMPS: deque[float] = deque(maxlen=0x10000)
+ORDER_LOCK = threading.Lock()
+HEAD_LOCK = threading.Lock()  # serializes client head writes
+order_drops = 0
+order_tail = 0  # authoritative; REG_ORDER_TAIL only mirrors it
+
+
+def overlaps(ranges, address: int, count: int) -> bool:
+    return any(address < hi and address + count > lo for lo, hi in ranges)
+
+
+def decode_order(length: int, words: list[int]) -> bytes:
+    if length == 0:
+        buf = bytearray()
+        for w in words:
+            if w == 0:
+                break
+            buf.append(w & 0xFF)
+        return bytes(buf)
+    return bytes([(w & 0xFF) for w in words[:length]])
+
+
+class TriggerDataBank(DataBank):
+    """Wakes the PLC worker on client writes to the trigger/head registers."""
+
+    def set_holding_registers(self, address, word_list, srv_info=None):
+        end = address + len(word_list)
+        if srv_info and overlaps(READ_ONLY_REGS, address, len(word_list)):
+            return None  # read-only: the server answers with an exception
+        if srv_info and address <= REG_ORDER_HEAD < end:
+            with HEAD_LOCK:
+                head = (self.get_holding_registers(REG_ORDER_HEAD, 1) or [0])[0]
+                added = (int(word_list[REG_ORDER_HEAD - address]) - head) & 0xFFFF
+                if added >= 0x8000:
+                    return None  # head may only move forward
+                ok = super().set_holding_registers(address, word_list, srv_info)
+                if ok:
+                    now = time.perf_counter()
+                    with ORDER_LOCK:
+                        RING_STAMPS.extend([now] * min(added, ORDER_SLOTS * 2))
+                    TRIGGER.set()
+        else:
+            ok = super().set_holding_registers(address, word_list, srv_info)
+        if not (ok and srv_info):
+            return ok
+        if address <= REG_ORDER_TRIGGER < end:
+            if int(word_list[REG_ORDER_TRIGGER - address]) == 1:
+                self._queue_legacy_order()
+                TRIGGER.set()
+        if address <= REG_FETCH_TRIGGER < end:
+            if int(word_list[REG_FETCH_TRIGGER - address]) == 1:
+                TRIGGER.set()
+        return ok
+
+    def set_coils(self, address, bit_list, srv_info=None):
+        if srv_info and overlaps(READ_ONLY_COILS, address, len(bit_list)):
+            return None
+        return super().set_coils(address, bit_list, srv_info)
+
+    def _queue_legacy_order(self) -> None:
+        global order_drops
+        t0 = time.perf_counter()
+        regs = self.get_holding_registers(REG_ORDER_LEN, 1 + ORDER_DATA_WORDS)
+        payload = decode_order(regs[0], regs[1:])
+        METRICS.order_decode.observe(time.perf_counter() - t0)
+        with ORDER_LOCK:
+            if len(LEGACY_ORDERS) >= ORDER_SLOTS:
+                order_drops += 1
+            else:
+                LEGACY_ORDERS.append((t0, payload))
+        self.set_holding_registers(REG_ORDER_TRIGGER, [0])
+
 
-server = ModbusServer(host="0.0.0.0", port=502, no_block=True)
+server = ModbusServer(
+    host="0.0.0.0", port=502, no_block=True, data_bank=TriggerDataBank()
+)
 print("[plc] starting Modbus gateway on :502")
 server.start()
 db = server.data_bank
 
 try:
     db.set_holding_registers(99, [0])
-    db.set_holding_registers(200, [0])
-    db.set_holding_registers(210, [0])
+    db.set_holding_registers(REG_ORDER_TRIGGER, [0])
+    db.set_holding_registers(REG_FETCH_TRIGGER, [0])
     db.set_holding_registers(120, [0] * 60)
     db.set_holding_registers(400, [0] * 64)
+    db.set_holding_registers(REG_ORDER_HEAD, [0, 0, 0, 0])
+    db.set_holding_registers(REG_METRICS_BASE, [0] * METRICS_WORDS)
+    db.set_holding_registers(ORDER_RING_BASE, [0] * (ORDER_SLOTS * ORDER_SLOT_WORDS))
 except Exception as e:
     print("[plc] init registers failed:", e, flush=True)
 
 
-try:
+def run_order(payload: bytes, arrived: float | None) -> None:
+    t0 = time.perf_counter()
+    try:
+        LIB.process_production_order(ctypes.c_char_p(payload + b"\x00"))
+    except Exception as e:
+        if DEBUG:
+            print("[plc] error calling PLC lib:", e, flush=True)
+    t1 = time.perf_counter()
+    METRICS.order_exec.observe(t1 - t0)
+    if arrived is not None:
+        METRICS.order_latency.observe(t1 - arrived)
+    METRICS.orders_processed += 1
+
+
+def publish_queue(tail: int) -> None:
+    head = (db.get_holding_registers(REG_ORDER_HEAD, 1) or [0])[0]
+    with ORDER_LOCK:
+        depth = ((head - tail) & 0xFFFF) + len(LEGACY_ORDERS)
+        drops = order_drops
+    db.set_holding_registers(REG_ORDER_TAIL, [tail, min(depth, 0xFFFF), drops & 0xFFFF])
+
+
+def drain_orders() -> None:
+    """Run every queued order in FIFO order (legacy FIFO first, then the ring)."""
+    global order_drops, order_tail
     while True:
-        ctrl_regs = db.get_holding_registers(200, 1) or [0]
-        if ctrl_regs[0] == 1:
-            words = db.get_holding_registers(100, 100) or [0] * 100
-            length = (db.get_holding_registers(99, 1) or [0])[0]
-            if length == 0:
-                buf = bytearray()
-                for w in words:
-                    if w == 0:
-                        break
-                    buf.append(w & 0xFF)
-                payload = bytes(buf)
-            else:
-                payload = bytes([(w & 0xFF) for w in words[:length]])
-            try:
-                LIB.process_production_order(ctypes.c_char_p(payload + b"\x00"))
-            except Exception as e:
-                if DEBUG:
-                    print("[plc] error calling PLC lib:", e, flush=True)
-            finally:
-                db.set_holding_registers(200, [0])
-
-        fetch = (db.get_holding_registers(210, 1) or [0])[0]
-        compromised = int(LIB.plc_compromised())
-        if fetch == 1:
-            if compromised:
-                blob = FLAG_STORE.concat_all_latest(sep="\n", max_bytes=64)
-            else:
-                blob = b""
-            out = blob.ljust(64, b"\x00")
-            db.set_holding_registers(400, list(out))
-            db.set_holding_registers(210, [0])
+        with ORDER_LOCK:
+            item = LEGACY_ORDERS.popleft() if LEGACY_ORDERS else None
+        if item is None:
+            break
+        arrived, payload = item
+        run_order(payload, arrived)
+
+    tail = order_tail
+    while True:
+        head = (db.get_holding_registers(REG_ORDER_HEAD, 1) or [0])[0]
+        pending = (head - tail) & 0xFFFF
+        if pending == 0:
+            break
+        if pending > ORDER_SLOTS:
+            # producer lapped the ring: the oldest slots were overwritten
+            with ORDER_LOCK:
+                order_drops += pending - ORDER_SLOTS
+                for _ in range(min(pending - ORDER_SLOTS, len(RING_STAMPS))):
+                    RING_STAMPS.popleft()
+            tail = (head - ORDER_SLOTS) & 0xFFFF
+        t0 = time.perf_counter()
+        base = ORDER_RING_BASE + (tail % ORDER_SLOTS) * ORDER_SLOT_WORDS
+        regs = db.get_holding_registers(base, ORDER_SLOT_WORDS)
+        payload = decode_order(regs[0], regs[1:])
+        METRICS.order_decode.observe(time.perf_counter() - t0)
+        with ORDER_LOCK:
+            arrived = RING_STAMPS.popleft() if RING_STAMPS else None
+        run_order(payload, arrived)
+        tail = order_tail = (tail + 1) & 0xFFFF
+        publish_queue(tail)
+    publish_queue(tail)
+
+
+def handle_fetch() -> None:
+    t0 = time.perf_counter()
+    if int(LIB.plc_compromised()):
+        blob = FLAG_STORE.concat_all_latest(sep="\n", max_bytes=64)
+    else:
+        blob = b""
+    out = blob.ljust(64, b"\x00")
+    db.set_holding_registers(400, list(out))
+    db.set_holding_registers(REG_FETCH_TRIGGER, [0])
+    METRICS.flag_fetch.observe(time.perf_counter() - t0)
+    METRICS.fetches_served += 1
+
+
+# Status block 300..310: conveyor, estop_ok, quality hi/lo, 304..309 reserved,
+# compromised. Published with one write, and only when it changed.
+STATUS = PlcStatus()
+_last_status: list[int] | None = None
+
+
+def publish_status() -> None:
+    t0 = time.perf_counter()
+    _publish_status()
+    METRICS.status_publish.observe(time.perf_counter() - t0)
+
 
-        conveyor = int(LIB.get_conveyor_run())
-        estop_ok = int(LIB.get_emergency_ok())
-        quality = int(LIB.get_quality_score())
+def _publish_status() -> None:
+    global _last_status
+    LIB.plc_get_status(ctypes.byref(STATUS))
+    conveyor = int(STATUS.conveyor_run)
+    estop_ok = int(STATUS.emergency_ok)
+    quality = int(STATUS.quality_score)
 
+    block = [conveyor, estop_ok, (quality >> 16) & 0xFFFF, quality & 0xFFFF]
+    block += [0] * 6 + [int(STATUS.compromised)]
+    if block == _last_status:
+        return
+
+    try:
+        server.data_bank.set_coils(0, [conveyor == 1, estop_ok == 1])
+    except Exception:
+        pass
+
+    db.set_holding_registers(REG_STATUS_BASE, block)
+    _last_status = block
+
+
+def plc_worker() -> None:
+    publish_status()
+    while True:
+        TRIGGER.wait()
+        # clear before reading: a write landing after this re-arms the event
+        TRIGGER.clear()
+        t0 = time.perf_counter()
         try:
-            server.data_bank.set_coils(0, [conveyor == 1, estop_ok == 1])
-        except Exception:
-            pass
+            drain_orders()
+            if (db.get_holding_registers(REG_FETCH_TRIGGER, 1) or [0])[0] == 1:
+                handle_fetch()
+            publish_status()
+        except Exception as e:
+            if DEBUG:
+                print("[plc] worker error:", e, flush=True)
+        dt = time.perf_counter() - t0
+        METRICS.worker_loop.observe(dt)
+        if dt > LOOP_BUDGET_SECS:
+            METRICS.loop_overruns += 1
+        db.set_holding_registers(REG_METRICS_BASE, METRICS.registers())
+
 
-        db.set_holding_registers(300, [conveyor])
-        db.set_holding_registers(301, [estop_ok])
-        db.set_holding_registers(302, [(quality >> 16) & 0xFFFF])
-        db.set_holding_registers(303, [quality & 0xFFFF])
-        db.set_holding_registers(310, [compromised])
+worker = threading.Thread(target=plc_worker, daemon=True)
+worker.start()
 
-        time.sleep(0.2)
+try:
+    worker.join()
 except KeyboardInterrupt:
     pass
 finally:
@@ -6,6 +6,8 @@
 #include <stdint.h>
 #include <string.h>
 
+#include "plc_shared.h"
+
 static volatile int g_compromised = 0;
 static volatile uint8_t g_conveyor_run = 1;    
 static volatile uint8_t g_emergency_ok = 1;    
@@ -24,6 +26,15 @@ uint8_t get_conveyor_run(void) { return g_conveyor_run; }
 uint8_t get_emergency_ok(void) { return g_emergency_ok; }
 uint32_t get_quality_score(void) { return g_quality_score; }
 
+void plc_get_status(plc_status_t *out)
+{
+    out->compromised = g_compromised;
+    out->conveyor_run = g_conveyor_run;
+    out->emergency_ok = g_emergency_ok;
+    out->reserved = 0;
+    out->quality_score = g_quality_score;
+}
+
 static void parse_pairs(const char *buf)
 {
     const char *p = buf;
@@ -14,6 +14,18 @@ extern "C"
     uint8_t get_emergency_ok(void);
     uint32_t get_quality_score(void);
 
+    typedef struct
+    {
+        int32_t compromised;
+        uint8_t conveyor_run;
+        uint8_t emergency_ok;
+        uint16_t reserved;
+        uint32_t quality_score;
+    } plc_status_t;
+
+    /* Snapshot of all status fields in one call. */
+    void plc_get_status(plc_status_t *out);
+
 #ifdef __cplusplus
 }
 #endif
@@ -10,6 +10,7 @@ DB_HOST = os.getenv("DB_HOST", "historiandb")
 DB_NAME = os.getenv("DB_NAME", "histdb")
 DB_USER = os.getenv("DB_USER", "hist")
 DB_PASS = os.getenv("DB_PASS", "histpass")
+HIST_DEVICE = os.getenv("HIST_DEVICE", PLC_HOST)
 
 TPL = """
 <!doctype html><html><head><meta charset=utf-8><title>SCADA</title></head><body>
@@ -40,7 +41,8 @@ def index():
     ) as db:
         with db.cursor() as cur:
             cur.execute(
-                "SELECT ts, conveyor_run, emergency_ok, quality_score FROM process_metrics ORDER BY ts DESC LIMIT 15"
+                "SELECT ts, conveyor_run, emergency_ok, quality_score FROM process_metrics WHERE device = %s ORDER BY ts DESC LIMIT 15",
+                (HIST_DEVICE,),
             )
             rows = cur.fetchall()
     return render_template_string(
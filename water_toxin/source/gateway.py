@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import os
+import sys
 import time
+import atexit
+import signal
 import logging
 import random
 import struct
@@ -8,13 +11,23 @@ import hashlib
 import base64
 import sqlite3
 import threading
+import queue
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
 from pathlib import Path
 from typing import List
 
 from pyModbusTCP.client import ModbusClient
+from pyModbusTCP.constants import MB_NO_ERR, MB_EXCEPT_ERR
 
 from pymodbus.datastore.store import BaseModbusDataBlock
-from pymodbus.server import StartTcpServer
+from pymodbus.server import ModbusTcpServer
+from pymodbus.server.async_io import ModbusServerRequestHandler
+from pymodbus.exceptions import NoSuchSlaveException
+from pymodbus.framer import Framer
 from pymodbus.datastore import (
     ModbusServerContext,
     ModbusSlaveContext,
@@ -35,6 +48,16 @@ log = logging.getLogger("gate")
 BACKEND_HOST = os.getenv("BACKEND_HOST", "127.0.0.1")
 BACKEND_PORT = int(os.getenv("BACKEND_PORT", "1502"))
 GATE_PORT = int(os.getenv("GATE_PORT", "502"))
+# Clients per backend. Requests for a unit run one at a time on that unit's
+# worker thread; extra clients let write-behind flushes run alongside them.
+BACKEND_POOL_SIZE = max(1, int(os.getenv("BACKEND_POOL_SIZE", "1")))
+BACKEND_TIMEOUT_SECS = float(os.getenv("BACKEND_TIMEOUT_SECS", "3.0"))
+# After a connection-level failure, calls to that backend fail immediately
+# for this long instead of each waiting out the timeout.
+BACKEND_RETRY_SECS = float(os.getenv("BACKEND_RETRY_SECS", "5.0"))
+# Multi-PLC routing: "unit=host:port,unit=host:port,...". When empty, the single
+# BACKEND_HOST:BACKEND_PORT backend answers every unit ID.
+GATEWAY_BACKENDS = os.getenv("GATEWAY_BACKENDS", "").strip()
 
 RO_REGION_START, RO_REGION_END = 200, 679
 SLOTS, SLOT_SIZE = 15, 32
@@ -71,21 +94,489 @@ AUTH_PUT, AUTH_GET = 1, 2
 RESP_TTL_SECS = float(os.getenv("CHK_RESP_TTL_SECS", "0.8"))
 CHECKER_PUBKEY_B64 = os.getenv("CHECKER_PUBKEY_B64", "")
 
+# Latency histograms; METRICS_PORT=0 keeps them internal (no HTTP endpoint).
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+SLOW_TX_MS = float(os.getenv("SLOW_TX_MS", "250"))
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+# Client traffic capture (see replay.py); empty disables it.
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "")
+
+# Write-behind for passthrough writes; 0 forwards every write immediately.
+WRITE_COALESCE_MS = float(os.getenv("WRITE_COALESCE_MS", "0"))
+MAX_WRITE_REGS, MAX_WRITE_COILS = 123, 1968
+# Failed write-behind runs are kept and retried after at least this long.
+WRITE_RETRY_SECS = float(os.getenv("WRITE_RETRY_SECS", "1.0"))
+
+SIG_CACHE_SIZE = int(os.getenv("SIG_CACHE_SIZE", "1024"))
+
 FLAGS_DB_PATH = os.getenv("FLAGS_DB_PATH", "/data/flags.db")
 
+# History retention: a row survives while it is among the newest KEEP_ROWS of
+# its slot or younger than KEEP_SECS (0 disables the age rule).
+FLAGS_KEEP_ROWS = max(1, int(os.getenv("FLAGS_KEEP_ROWS", "32")))
+FLAGS_KEEP_SECS = int(os.getenv("FLAGS_KEEP_SECS", "0"))
+FLAGS_PRUNE_INTERVAL_SECS = float(os.getenv("FLAGS_PRUNE_INTERVAL_SECS", "30"))
+FLAGS_PRUNE_BATCH = int(os.getenv("FLAGS_PRUNE_BATCH", "256"))
+FLAGS_VACUUM_PAGES = int(os.getenv("FLAGS_VACUUM_PAGES", "256"))
+
 
 def in_range(addr: int, count: int, lo: int, hi: int) -> bool:
     return (addr <= hi) and (addr + count - 1 >= lo)
 
 
+def region_of(address: int, count: int) -> str:
+    if in_range(address, count, CHK_SEED_L, CHK_SIG_END):
+        return "checker"
+    if (
+        in_range(address, count, PTR_TABLE_BASE, PTR_TABLE_END)
+        or in_range(address, count, REG_PTR_LOCK_BASE, REG_PTR_LOCK_BASE + 1)
+        or in_range(address, count, REG_PTR_OPEN, REG_PTR_OPEN)
+    ):
+        return "ptr_table"
+    if in_range(address, count, RO_REGION_START, RO_REGION_END) or (
+        address == RO_READ_TRIG
+    ):
+        return "ro_region"
+    return "passthrough"
+
+
+CAPTURE_MAGIC = b"WTCAP1\n"
+CAPTURE_REC = struct.Struct(">dBBHH")
+CAPTURE_WRITE = 0x80
+
+
+class TrafficCapture:
+    """Appends every client request to a compact binary log.
+
+    Layout: CAPTURE_MAGIC, then per datastore access a CAPTURE_REC header
+    (seconds since start, unit, function code, address, count). Each process
+    appending to the file starts a new session with another CAPTURE_MAGIC, and
+    its timestamps restart at 0. Writes set
+    CAPTURE_WRITE in the function code byte and are followed by the values:
+    `count` big-endian words for registers, `count` bytes for coils. Reads
+    carry no values; write requests also produce a read for their echo.
+    """
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.f = open(path, "ab", buffering=1 << 16)
+        self.f.write(CAPTURE_MAGIC)
+        self.t0 = time.monotonic()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._flusher, name="capture", daemon=True).start()
+        atexit.register(self.close)
+
+    def record(self, unit: int, fc: int, address: int, count: int, values=None):
+        t = time.monotonic() - self.t0
+        if values is None:
+            rec = CAPTURE_REC.pack(t, unit, fc, address, count)
+        else:
+            rec = CAPTURE_REC.pack(t, unit, fc | CAPTURE_WRITE, address, count)
+            if fc in (5, 15):
+                rec += bytes(1 if v else 0 for v in values)
+            else:
+                rec += struct.pack(
+                    f">{len(values)}H", *(int(v) & 0xFFFF for v in values)
+                )
+        with self.lock:
+            if not self.f.closed:
+                self.f.write(rec)
+
+    def close(self):
+        with self.lock:
+            if not self.f.closed:
+                self.f.close()
+
+    def _flusher(self):
+        while True:
+            time.sleep(1.0)
+            with self.lock:
+                if self.f.closed:
+                    return
+                self.f.flush()
+
+
+class CapturingSlaveContext(ModbusSlaveContext):
+    """ModbusSlaveContext that logs each request before serving it."""
+
+    def __init__(self, *args, unit: int = 0, capture: TrafficCapture, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unit = unit
+        self.capture = capture
+
+    def getValues(self, fc_as_hex, address, count=1):
+        self.capture.record(self.unit, fc_as_hex, address, count)
+        return super().getValues(fc_as_hex, address, count)
+
+    def setValues(self, fc_as_hex, address, values):
+        self.capture.record(self.unit, fc_as_hex, address, len(values), values)
+        return super().setValues(fc_as_hex, address, values)
+
+
+class Metrics:
+    """Per-(op, region) latency histograms plus a per-thread transaction breakdown."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, slow_secs=SLOW_TX_MS / 1000.0):
+        self.buckets = buckets
+        self.slow_secs = slow_secs
+        self.hist: dict[tuple, list] = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def observe(self, op: str, region: str, secs: float) -> None:
+        with self.lock:
+            h = self.hist.get((op, region))
+            if h is None:
+                # bucket counts, then +Inf count and sum
+                h = self.hist[(op, region)] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, b in enumerate(self.buckets):
+                if secs <= b:
+                    h[i] += 1
+                    break
+            else:
+                h[len(self.buckets)] += 1
+            h[-1] += secs
+
+    def timed(self, op: str) -> "_Timer":
+        return _Timer(self, op)
+
+    def transaction(
+        self, kind: str, address: int, count: int, region: str | None = None
+    ) -> "_Transaction":
+        """`region` defaults to the holding-register region of the range."""
+        if region is None:
+            region = region_of(address, count)
+        return _Transaction(self, kind, region, address, count)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP gateway_op_seconds Gateway operation latency.",
+            "# TYPE gateway_op_seconds histogram",
+        ]
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.hist.items())
+        for (op, region), h in items:
+            labels = f'op="{op}",region="{region}"'
+            acc = 0
+            for b, n in zip(self.buckets, h):
+                acc += n
+                lines.append(f'gateway_op_seconds_bucket{{{labels},le="{b}"}} {acc}')
+            acc += h[len(self.buckets)]
+            lines.append(f'gateway_op_seconds_bucket{{{labels},le="+Inf"}} {acc}')
+            lines.append(f"gateway_op_seconds_sum{{{labels}}} {h[-1]:.6f}")
+            lines.append(f"gateway_op_seconds_count{{{labels}}} {acc}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        srv = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        srv.daemon_threads = True
+        threading.Thread(target=srv.serve_forever, name="metrics", daemon=True).start()
+        return srv
+
+
+class _Timer:
+    __slots__ = ("m", "op", "t0")
+
+    def __init__(self, m: Metrics, op: str):
+        self.m = m
+        self.op = op
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        tx = getattr(self.m.local, "tx", None)
+        self.m.observe(self.op, tx.region if tx else "background", dt)
+        if tx:
+            tx.parts[self.op] = tx.parts.get(self.op, 0.0) + dt
+        return False
+
+
+class _Transaction:
+    __slots__ = ("m", "kind", "region", "address", "count", "parts", "t0", "outer")
+
+    def __init__(self, m: Metrics, kind: str, region: str, address: int, count: int):
+        self.m = m
+        self.kind = kind
+        self.region = region
+        self.address = address
+        self.count = count
+        self.parts: dict[str, float] = {}
+
+    def __enter__(self):
+        self.outer = getattr(self.m.local, "tx", None)
+        self.m.local.tx = self
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        self.m.local.tx = self.outer
+        self.m.observe(self.kind, self.region, dt)
+        if dt >= self.m.slow_secs:
+            parts = " ".join(f"{k}={v * 1000:.1f}ms" for k, v in self.parts.items())
+            log.warning(
+                f"slow {self.kind} {self.region} {self.address}:{self.count} "
+                f"{dt * 1000:.1f}ms [{parts}]"
+            )
+        return False
+
+
+METRICS = Metrics()
+
+
+def parse_backends(spec: str) -> dict[int, tuple[str, int]]:
+    out = {}
+    for item in spec.replace(";", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        unit, _, addr = item.partition("=")
+        host, _, port = addr.strip().rpartition(":")
+        if not unit.strip() or not host:
+            raise ValueError(f"bad backend spec: {item!r}")
+        uid = int(unit)
+        if not 0 <= uid <= 247:
+            raise ValueError(f"unit id out of range: {uid}")
+        if uid in out:
+            raise ValueError(f"duplicate unit id: {uid}")
+        out[uid] = (host, int(port))
+    return out
+
+
+def flags_db_path_for(unit: int) -> str:
+    p = Path(FLAGS_DB_PATH)
+    return str(p.with_name(f"{p.stem}.unit{unit}{p.suffix}"))
+
+
+class BackendPool:
+    """Fixed set of backend clients; each call leases one for its duration.
+
+    A read_*/write_* call that fails at the connection level (rather than with
+    a Modbus exception reply) opens a breaker: calls return None without any
+    I/O until BACKEND_RETRY_SECS have passed.
+    """
+
+    def __init__(self, host: str, port: int, size: int = BACKEND_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.clients: queue.Queue = queue.Queue()
+        for _ in range(max(1, size)):
+            self.clients.put(
+                ModbusClient(host, port, auto_open=True, timeout=BACKEND_TIMEOUT_SECS)
+            )
+        self.down_until = 0.0
+
+    def __getattr__(self, name):
+        if not callable(getattr(ModbusClient, name, None)):
+            raise AttributeError(name)
+        guarded = name.startswith(("read_", "write_"))
+
+        def call(*args, **kwargs):
+            if guarded and time.monotonic() < self.down_until:
+                return None
+            c = self.clients.get()
+            try:
+                r = getattr(c, name)(*args, **kwargs)
+                err = c.last_error
+            finally:
+                self.clients.put(c)
+            if guarded:
+                if r is None and err not in (MB_NO_ERR, MB_EXCEPT_ERR):
+                    if not self.down_until:
+                        log.warning(
+                            f"backend {self.host}:{self.port} down: {c.last_error_as_txt}"
+                        )
+                    self.down_until = time.monotonic() + BACKEND_RETRY_SECS
+                elif self.down_until:
+                    log.warning(f"backend {self.host}:{self.port} back up")
+                    self.down_until = 0.0
+            return r
+
+        return call
+
+
+class TimedBackend:
+    """Wraps the backend client so every read_*/write_* call is timed."""
+
+    def __init__(self, client: "ModbusClient | BackendPool"):
+        self.client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith("read_"):
+            op = "backend_read"
+        elif name.startswith("write_"):
+            op = "backend_write"
+        else:
+            return attr
+
+        def call(*args, **kwargs):
+            with METRICS.timed(op):
+                return attr(*args, **kwargs)
+
+        return call
+
+
+class WriteBehind:
+    """Merges passthrough writes into contiguous runs flushed after `window` secs.
+
+    Values stay visible through `overlay` until the backend write for them has
+    succeeded, so reads through the gateway always see their own writes; failed
+    runs go back to `pending` and are retried. Backend calls are serialized by
+    the client pool lease.
+    """
+
+    def __init__(self, name: str, write_single, write_multiple, window, max_run):
+        self.name = name
+        self.write_single = write_single
+        self.write_multiple = write_multiple
+        self.window = window
+        self.max_run = max_run
+        self.pending: dict[int, object] = {}
+        self.inflight: dict[int, object] = {}
+        self.deadline = 0.0
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        threading.Thread(target=self._run, name=f"wb-{name}", daemon=True).start()
+
+    def put(self, address: int, values: list) -> None:
+        with self.cond:
+            if not self.pending:
+                self.deadline = time.monotonic() + self.window
+                self.cond.notify()
+            for i, v in enumerate(values):
+                self.pending[address + i] = v
+
+    def overlay(self, address: int, count: int) -> dict:
+        with self.cond:
+            if not self.pending and not self.inflight:
+                return {}
+            out = {}
+            for src in (self.inflight, self.pending):
+                for a in range(address, address + count):
+                    if a in src:
+                        out[a] = src[a]
+            return out
+
+    def apply(self, vals: list, address: int, snap: dict) -> list:
+        for a, v in snap.items():
+            vals[a - address] = v
+        return vals
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.cond:
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, {}
+                self.inflight.update(batch)
+            failed = dict(batch)
+            try:
+                for start, run in self._runs(batch):
+                    if len(run) == 1:
+                        ok = self.write_single(start, run[0])
+                    else:
+                        ok = self.write_multiple(start, run)
+                    if ok:
+                        for a in range(start, start + len(run)):
+                            del failed[a]
+                    else:
+                        log.warning(
+                            f"backend {self.name} write {start}:{len(run)} failed"
+                        )
+            finally:
+                with self.cond:
+                    self.inflight.clear()
+                    # keep failed values visible and retry them; a newer
+                    # put() for the same address wins
+                    if failed:
+                        if not self.pending:
+                            self.deadline = time.monotonic() + max(
+                                self.window, WRITE_RETRY_SECS
+                            )
+                            self.cond.notify()
+                        for a, v in failed.items():
+                            self.pending.setdefault(a, v)
+
+    def _runs(self, batch: dict):
+        addrs = sorted(batch)
+        start = prev = addrs[0]
+        run = [batch[start]]
+        for a in addrs[1:]:
+            if a == prev + 1 and len(run) < self.max_run:
+                run.append(batch[a])
+            else:
+                yield start, run
+                start, run = a, [batch[a]]
+            prev = a
+        yield start, run
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                delay = self.deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.flush()
+            except Exception as e:
+                log.warning(f"write-behind {self.name} flush error: {e}")
+
+
 class FlagDB:
-    """Simple SQLite wrapper for persisted flags."""
+    """Simple SQLite wrapper for persisted flags.
+
+    Writes go through ``conn`` under ``lock``. The latest payload per slot is
+    kept in memory (warmed at startup, updated on insert); cold lookups use a
+    separate read-only connection so readers never queue behind writers.
+    """
 
     def __init__(self, db_path: str):
         self.db_path = db_path
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.lock = threading.Lock()
+        with self.lock:
+            # auto_vacuum only takes effect on an existing file after VACUUM
+            if self.conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+                self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+                self.conn.execute("VACUUM;")
         with self.lock, self.conn:
             self.conn.execute("PRAGMA journal_mode=WAL;")
             self.conn.execute(
@@ -107,23 +598,111 @@ class FlagDB:
             """
             )
 
+        self.read_conn = sqlite3.connect(
+            f"file:{db_path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self.read_lock = threading.Lock()
+        self.latest: dict[int, bytes] = {}
+        self._warm_latest()
+
+    def _warm_latest(self) -> None:
+        with self.read_lock:
+            slots = [
+                r[0] for r in self.read_conn.execute("SELECT DISTINCT slot FROM flags")
+            ]
+        for slot in slots:
+            payload = self._read_latest(slot)
+            if payload is not None:
+                self.latest.setdefault(slot, payload)
+
+    def _read_latest(self, slot: int) -> bytes | None:
+        with self.read_lock:
+            cur = self.read_conn.execute(
+                "SELECT payload FROM flags WHERE slot=? ORDER BY created_at DESC, id DESC LIMIT 1",
+                (slot,),
+            )
+            row = cur.fetchone()
+        return bytes(row[0]) if row else None
+
     def insert_flag(self, slot: int, payload: bytes) -> None:
         h = hashlib.sha256(payload).hexdigest()
         ts = int(time.time())
-        with self.lock, self.conn:
-            self.conn.execute(
-                "INSERT INTO flags(slot, len, sha256, payload, created_at) VALUES(?,?,?,?,?)",
-                (slot, len(payload), h, sqlite3.Binary(payload), ts),
-            )
+        with METRICS.timed("db_insert"), self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO flags(slot, len, sha256, payload, created_at) VALUES(?,?,?,?,?)",
+                    (slot, len(payload), h, sqlite3.Binary(payload), ts),
+                )
+            self.latest[slot] = bytes(payload)
 
     def latest_for_slot(self, slot: int) -> bytes | None:
-        with self.lock:
+        payload = self.latest.get(slot)
+        if payload is not None:
+            return payload
+        with METRICS.timed("db_read"):
+            payload = self._read_latest(slot)
+        if payload is None:
+            return None
+        # an insert that landed meanwhile wins over what we just read
+        return self.latest.setdefault(slot, payload)
+
+    def prune_batch(self, keep_rows: int, keep_secs: int, batch: int) -> int:
+        """Delete up to `batch` rows that fall outside the retention policy."""
+        cutoff = int(time.time()) - keep_secs if keep_secs > 0 else 2**62
+        with self.lock, self.conn:
             cur = self.conn.execute(
-                "SELECT payload FROM flags WHERE slot=? ORDER BY created_at DESC, id DESC LIMIT 1",
-                (slot,),
+                """
+                DELETE FROM flags WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, created_at, ROW_NUMBER() OVER (
+                            PARTITION BY slot ORDER BY created_at DESC, id DESC
+                        ) AS rn
+                        FROM flags
+                    )
+                    WHERE rn > ? AND created_at < ?
+                    LIMIT ?
+                )
+            """,
+                (max(1, keep_rows), cutoff, batch),
             )
-            row = cur.fetchone()
-        return row[0] if row else None
+            return cur.rowcount
+
+    def prune(
+        self, keep_rows: int, keep_secs: int, batch: int, vacuum_pages: int
+    ) -> int:
+        deleted = 0
+        while True:
+            n = self.prune_batch(keep_rows, keep_secs, batch)
+            deleted += n
+            if n < batch:
+                break
+            time.sleep(0)  # let writers in between batches
+        if deleted:
+            with self.lock:
+                self.conn.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)});")
+        return deleted
+
+    def start_pruner(
+        self,
+        keep_rows: int = FLAGS_KEEP_ROWS,
+        keep_secs: int = FLAGS_KEEP_SECS,
+        interval: float = FLAGS_PRUNE_INTERVAL_SECS,
+        batch: int = FLAGS_PRUNE_BATCH,
+        vacuum_pages: int = FLAGS_VACUUM_PAGES,
+    ) -> threading.Thread:
+        def run():
+            while True:
+                try:
+                    n = self.prune(keep_rows, keep_secs, batch, vacuum_pages)
+                    if n:
+                        log.info(f"flags retention: pruned {n} rows")
+                except Exception as e:
+                    log.warning(f"flags retention error: {e}")
+                time.sleep(interval)
+
+        t = threading.Thread(target=run, name="flagdb-pruner", daemon=True)
+        t.start()
+        return t
 
 
 class GatewayCtrl:
@@ -136,6 +715,7 @@ class GatewayCtrl:
         self.ptr_window_until = 0.0
         self.ro_writable_until = 0.0
         self.slot_bases: List[int] = []
+        self.ptr_table_synced = False
 
         self.chk_len_full = 0
         self.chk_len = 0
@@ -150,6 +730,11 @@ class GatewayCtrl:
 
         self.stage_words = {}
 
+        # LRU of verdicts keyed by (seed, op, slot, length, payload hash, sig),
+        # so a checker retrying the same command skips the Ed25519 check
+        self.sig_cache: OrderedDict[tuple, bool] = OrderedDict()
+        self.sig_cache_lock = threading.Lock()
+
         # Ed25519 pubkey
         self.pubkey = None
         if CHECKER_PUBKEY_B64:
@@ -175,31 +760,71 @@ class GatewayCtrl:
 
     def refresh_seed(self):
         self.chk_seed = random.getrandbits(32)
+        with self.sig_cache_lock:
+            self.sig_cache.clear()
 
-    def verify_sig(self, op: int, slot: int, length: int) -> bool:
-        if not self.pubkey:
-            return False
-        msg = struct.pack(">I B B H", self.chk_seed, op, slot, length)
+    def _verify_raw(self, sig: bytes, msg: bytes) -> bool:
         try:
-            self.pubkey.verify(bytes(self.chk_sig), msg)
+            self.pubkey.verify(sig, msg)
             return True
         except InvalidSignature:
             return False
 
+    def _verify_cached(self, key: tuple, sig: bytes, msg: bytes) -> bool:
+        with METRICS.timed("sig_verify"):
+            return self._verify_cached_inner(key, sig, msg)
+
+    def _verify_cached_inner(self, key: tuple, sig: bytes, msg: bytes) -> bool:
+        with self.sig_cache_lock:
+            ok = self.sig_cache.get(key)
+            if ok is not None:
+                self.sig_cache.move_to_end(key)
+                return ok
+        try:
+            ok = self._verify_raw(sig, msg)
+        except Exception as e:
+            log.warning(f"signature verification error: {e}")
+            return False
+        with self.sig_cache_lock:
+            self.sig_cache[key] = ok
+            while len(self.sig_cache) > SIG_CACHE_SIZE:
+                self.sig_cache.popitem(last=False)
+        return ok
+
+    def verify_sig(self, op: int, slot: int, length: int) -> bool:
+        if not self.pubkey:
+            return False
+        sig = bytes(self.chk_sig)
+        msg = struct.pack(">I B B H", self.chk_seed, op, slot, length)
+        key = (self.chk_seed, op, slot, length, b"", sig)
+        return self._verify_cached(key, sig, msg)
+
     def verify_sig_with_payload(
         self, op: int, slot: int, length: int, payload_bytes: bytes
     ) -> bool:
         if not self.pubkey:
             return False
+        sig = bytes(self.chk_sig)
         ph = hashlib.sha256(payload_bytes[:MAX_FLAG_BYTES]).digest()[:16]
         msg = struct.pack(">I B B H", self.chk_seed, op, slot, length) + ph
-        try:
-            self.pubkey.verify(bytes(self.chk_sig), msg)
-            return True
-        except InvalidSignature:
-            return False
+        key = (self.chk_seed, op, slot, length, ph, sig)
+        return self._verify_cached(key, sig, msg)
 
     def poll_plc_state(self):
+        with METRICS.timed("poll"):
+            self._poll_plc_state()
+
+    def sync_ptr_table(self) -> None:
+        """Writes the slot pointer table to the PLC until one pass succeeds."""
+        if self.ptr_table_synced or not self.slot_bases:
+            return
+        for i, base in enumerate(self.slot_bases):
+            if not self.backend.write_single_register(PTR_TABLE_BASE + i, base):
+                return
+        self.ptr_table_synced = True
+
+    def _poll_plc_state(self):
+        self.sync_ptr_table()
         try:
             eng_unlock = self.backend.read_holding_registers(REG_ENG_UNLOCK, 1)
             eng_mode = self.backend.read_coils(COIL_ENG_MODE, 1)
@@ -223,17 +848,29 @@ class ProxyHolding(BaseModbusDataBlock):
         if len(all_bases) < SLOTS:
             raise RuntimeError("region too small")
         random.shuffle(all_bases)
+        # written to the PLC by the unit worker, see GatewayCtrl.sync_ptr_table
         self.ctrl.slot_bases = sorted(all_bases[:SLOTS])
 
-        for i, base in enumerate(self.ctrl.slot_bases):
-            _ = self.b.write_single_register(PTR_TABLE_BASE + i, base)
-
         self.ctrl.stage_words = {}
 
+        self.wb = None
+        if WRITE_COALESCE_MS > 0:
+            self.wb = WriteBehind(
+                "HR",
+                self.b.write_single_register,
+                self.b.write_multiple_registers,
+                WRITE_COALESCE_MS / 1000.0,
+                MAX_WRITE_REGS,
+            )
+
     def validate(self, address, count=1):
         return True
 
     def getValues(self, address, count=1):
+        with METRICS.transaction("hr_read", address, count):
+            return self._getValues(address, count)
+
+    def _getValues(self, address, count):
         self.ctrl.poll_plc_state()
 
         if in_range(address, count, CHK_LEN, CHK_DATA_END):
@@ -338,19 +975,29 @@ class ProxyHolding(BaseModbusDataBlock):
         ):
             return [0] * count
 
+        # snapshot before the backend read: a flush finishing in between has
+        # already landed on the PLC by the time we read it
+        snap = self.wb.overlay(address, count) if self.wb else {}
         vals = self.b.read_holding_registers(address, count)
         if vals is None:
             log.warning(f"backend HR[{address}:{count}] -> None")
-            return [0] * count
+            return self._overlay([0] * count, address, snap)
         if len(vals) != count:
             out = (vals or []) + [0] * (count - len(vals or []))
             log.warning(
                 f"backend HR short-read {address}:{count} -> {len(vals) if vals else 0}"
             )
-            return out
-        return vals
+            return self._overlay(out, address, snap)
+        return self._overlay(vals, address, snap)
+
+    def _overlay(self, vals, address, snap):
+        return self.wb.apply(vals, address, snap) if snap else vals
 
     def setValues(self, address, values: List[int]):
+        with METRICS.transaction("hr_write", address, len(values)):
+            self._setValues(address, values)
+
+    def _setValues(self, address, values: List[int]):
         self.ctrl.poll_plc_state()
 
         if in_range(address, len(values), CHK_SIG_BASE, CHK_SIG_END):
@@ -456,6 +1103,17 @@ class ProxyHolding(BaseModbusDataBlock):
         ):
             return
 
+        if self.wb:
+            # The unlock register is read straight from the backend by
+            # poll_plc_state, and RO-region writes are gated per window, so
+            # both go through; flushing first keeps them in client order.
+            if not in_range(
+                address, len(values), RO_REGION_START, RO_REGION_END
+            ) and not in_range(address, len(values), REG_ENG_UNLOCK, REG_ENG_UNLOCK):
+                self.wb.put(address, [int(v) for v in values])
+                return
+            self.wb.flush()
+
         if len(values) == 1:
             _ = self.b.write_single_register(address, int(values[0]))
         else:
@@ -469,47 +1127,146 @@ class ProxyCoils(ModbusSparseDataBlock):
         self.ctrl = ctrl
         self.b = ctrl.backend
 
+        self.wb = None
+        if WRITE_COALESCE_MS > 0:
+            self.wb = WriteBehind(
+                "COIL",
+                self.b.write_single_coil,
+                self.b.write_multiple_coils,
+                WRITE_COALESCE_MS / 1000.0,
+                MAX_WRITE_COILS,
+            )
+
     def validate(self, address, count=1):
         return True
 
     def getValues(self, address, count=1):
+        with METRICS.transaction("coil_read", address, count, "passthrough"):
+            return self._getValues(address, count)
+
+    def _getValues(self, address, count):
         self.ctrl.poll_plc_state()
+        snap = self.wb.overlay(address, count) if self.wb else {}
         vals = self.b.read_coils(address, count)
         if vals is None:
             log.warning(f"backend COIL[{address}:{count}] -> None")
-            return [0] * count
+            return self._overlay([0] * count, address, snap)
         if len(vals) != count:
             out = (vals or []) + [0] * (count - len(vals or []))
             log.warning(
                 f"backend COIL short-read {address}:{count} -> {len(vals) if vals else 0}"
             )
-            return out
-        return vals
+            return self._overlay(out, address, snap)
+        return self._overlay(vals, address, snap)
+
+    def _overlay(self, vals, address, snap):
+        return self.wb.apply(vals, address, snap) if snap else vals
 
     def setValues(self, address, values: List[int]):
+        with METRICS.transaction("coil_write", address, len(values), "passthrough"):
+            self._setValues(address, values)
+
+    def _setValues(self, address, values: List[int]):
         self.ctrl.poll_plc_state()
         bools = [bool(v) for v in values]
+        if self.wb:
+            # COIL_ENG_MODE is polled from the backend: write it through
+            if not in_range(address, len(bools), COIL_ENG_MODE, COIL_ENG_MODE):
+                self.wb.put(address, bools)
+                return
+            self.wb.flush()
         if len(bools) == 1:
             _ = self.b.write_single_coil(address, bools[0])
         else:
             _ = self.b.write_multiple_coils(address, bools)
 
 
-def main():
-    backend = ModbusClient(BACKEND_HOST, BACKEND_PORT, auto_open=True, timeout=3.0)
-    try:
-        backend.open()
-        _ = backend.read_holding_registers(10, 1)
-    except Exception as e:
-        log.error(f"backend init failed: {e}")
-
-    db = FlagDB(FLAGS_DB_PATH)
+def build_slave(
+    host: str,
+    port: int,
+    db_path: str,
+    unit: int = 0,
+    capture: TrafficCapture | None = None,
+) -> ModbusSlaveContext:
+    backend = TimedBackend(BackendPool(host, port))
+    db = FlagDB(db_path)
+    if FLAGS_PRUNE_INTERVAL_SECS > 0:
+        db.start_pruner()
     ctrl = GatewayCtrl(backend, db)
 
-    slave = ModbusSlaveContext(
-        di=None, co=ProxyCoils(ctrl), hr=ProxyHolding(ctrl), ir=None, zero_mode=True
-    )
-    ctx = ModbusServerContext(slaves=slave, single=True)
+    stores = dict(di=None, co=ProxyCoils(ctrl), hr=ProxyHolding(ctrl), ir=None)
+    if capture:
+        slave = CapturingSlaveContext(
+            **stores, zero_mode=True, unit=unit, capture=capture
+        )
+    else:
+        slave = ModbusSlaveContext(**stores, zero_mode=True)
+    # every backend call for this unit runs here, see UnitRequestHandler
+    slave.executor = ThreadPoolExecutor(1, thread_name_prefix=f"unit{unit}")
+    slave.executor.submit(ctrl.poll_plc_state)
+    return slave
+
+
+class UnitRequestHandler(ModbusServerRequestHandler):
+    """Runs each request on its unit's worker thread instead of the event loop.
+
+    Datastore calls block on backend I/O; off the loop, a slow or unreachable
+    PLC only delays requests for its own unit. Each unit's requests still run
+    in arrival order, and replies are handed back to the loop to be sent.
+    """
+
+    def execute(self, request, *addr):
+        try:
+            slave = self.server.context[request.slave_id]
+        except NoSuchSlaveException:
+            slave = None
+        self.loop = asyncio.get_running_loop()
+        executor = getattr(slave, "executor", None)
+        if executor is None or (self.server.broadcast_enable and not request.slave_id):
+            return super().execute(request, *addr)
+        executor.submit(super().execute, request, *addr)
+
+    def server_send(self, message, addr, **kwargs):
+        send = functools.partial(super().server_send, message, addr, **kwargs)
+        self.loop.call_soon_threadsafe(self._send_if_open, send)
+
+    def _send_if_open(self, send):
+        if self.transport:
+            send()
+
+
+class UnitDispatchServer(ModbusTcpServer):
+    def callback_new_connection(self):
+        return UnitRequestHandler(self)
+
+
+async def serve(ctx: ModbusServerContext, ident: ModbusDeviceIdentification):
+    server = UnitDispatchServer(ctx, Framer.SOCKET, ident, ("0.0.0.0", GATE_PORT))
+    await server.serve_forever()
+
+
+def main():
+    capture = TrafficCapture(CAPTURE_PATH) if CAPTURE_PATH else None
+    if capture:
+        log.info(f"capturing client traffic to {CAPTURE_PATH}")
+        # exit through atexit so the capture buffer is written out
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    if GATEWAY_BACKENDS:
+        slaves = {}
+        for unit, (host, port) in parse_backends(GATEWAY_BACKENDS).items():
+            slaves[unit] = build_slave(
+                host, port, flags_db_path_for(unit), unit=unit, capture=capture
+            )
+            log.info(f"unit {unit} -> {host}:{port}")
+        ctx = ModbusServerContext(slaves=slaves, single=False)
+    else:
+        slave = build_slave(BACKEND_HOST, BACKEND_PORT, FLAGS_DB_PATH, capture=capture)
+        ctx = ModbusServerContext(slaves=slave, single=True)
+
+    if METRICS_PORT:
+        METRICS.serve(METRICS_PORT)
+        log.info(f"metrics on :{METRICS_PORT}/metrics")
 
     ident = ModbusDeviceIdentification()
     ident.VendorName = "AcmeCorp"
@@ -519,7 +1276,7 @@ def main():
     ident.MajorMinorRevision = "3.1"
 
     log.info(f"listening on :{GATE_PORT}")
-    StartTcpServer(context=ctx, identity=ident, address=("0.0.0.0", GATE_PORT))
+    asyncio.run(serve(ctx, ident))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Replay a gateway traffic capture (CAPTURE_PATH) and report latency.
+
+By default the log is driven against a fresh gateway wired to a local
+WaterTreatmentPLC simulator, both started by this tool. Use --host/--port to
+target an already running gateway instead.
+"""
+
+import argparse
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from pyModbusTCP.client import ModbusClient
+
+from gateway import CAPTURE_MAGIC, CAPTURE_REC, CAPTURE_WRITE
+
+HERE = Path(__file__).resolve().parent
+WRITE_FCS = (5, 6, 15, 16)
+# What the datastore saw for 22 (mask write: read then write) and 23
+# (read/write multiple: write then read) is replayed as plain 3/16 requests.
+REPLAY_FCS = (1, 2, 3, 4, 5, 6, 15, 16, 22, 23)
+
+
+def read_capture(path: str) -> list[tuple]:
+    data = Path(path).read_bytes()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError(f"{path}: not a gateway capture")
+    out = []
+    off = len(CAPTURE_MAGIC)
+    # each appended session restarts at t=0: continue from the previous one
+    base = last = 0.0
+    while off + CAPTURE_REC.size <= len(data):
+        if data.startswith(CAPTURE_MAGIC, off):
+            off += len(CAPTURE_MAGIC)
+            base = last
+            continue
+        t, unit, fc, address, count = CAPTURE_REC.unpack_from(data, off)
+        off += CAPTURE_REC.size
+        t = last = base + t
+        if not fc & CAPTURE_WRITE:
+            if fc in WRITE_FCS:
+                continue  # response echo of the preceding write
+            out.append((t, unit, fc, address, count, None))
+            continue
+        fc &= ~CAPTURE_WRITE
+        size = count if fc in (5, 15) else count * 2
+        if off + size > len(data):
+            break  # capture cut short mid-record
+        if fc in (5, 15):
+            values = [bool(b) for b in data[off : off + count]]
+            off += count
+        else:
+            values = list(struct.unpack_from(f">{count}H", data, off))
+            off += count * 2
+        out.append((t, unit, fc, address, count, values))
+    return out
+
+
+def issue(c: ModbusClient, fc: int, address: int, count: int, values):
+    if fc == 1:
+        return c.read_coils(address, count)
+    if fc == 2:
+        return c.read_discrete_inputs(address, count)
+    if fc in (3, 22, 23):
+        return c.read_holding_registers(address, count)
+    if fc == 4:
+        return c.read_input_registers(address, count)
+    if fc == 5:
+        return c.write_single_coil(address, values[0])
+    if fc == 6:
+        return c.write_single_register(address, values[0])
+    if fc == 15:
+        return c.write_multiple_coils(address, values)
+    if fc in (16, 22, 23):
+        return c.write_multiple_registers(address, values)
+    return None
+
+
+def percentile(sorted_vals: list[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, int(round(p / 100.0 * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+
+def replay(records, host: str, port: int, speed: float) -> dict:
+    clients: dict[int, ModbusClient] = {}
+    lat: list[float] = []
+    errors = skipped = 0
+    t_start = time.monotonic()
+    t_first = records[0][0] if records else 0.0
+    for t, unit, fc, address, count, values in records:
+        if fc not in REPLAY_FCS:
+            skipped += 1
+            continue
+        if speed > 0:
+            delay = (t - t_first) / speed - (time.monotonic() - t_start)
+            if delay > 0:
+                time.sleep(delay)
+        c = clients.get(unit)
+        if c is None:
+            c = clients[unit] = ModbusClient(
+                host, port, unit_id=unit or 1, auto_open=True, timeout=3.0
+            )
+        t0 = time.perf_counter()
+        res = issue(c, fc, address, count, values)
+        lat.append(time.perf_counter() - t0)
+        if res is None or res is False:
+            errors += 1
+    elapsed = time.monotonic() - t_start
+    for c in clients.values():
+        c.close()
+    lat.sort()
+    return {
+        "requests": len(lat),
+        "errors": errors,
+        "skipped": skipped,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(lat) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(lat, 50) * 1000,
+        "p90_ms": percentile(lat, 90) * 1000,
+        "p99_ms": percentile(lat, 99) * 1000,
+        "max_ms": (lat[-1] if lat else 0.0) * 1000,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float = 15.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on :{port}")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("capture")
+    p.add_argument("--speed", type=float, default=1.0, help="1 = real time, 0 = max")
+    p.add_argument("--host", help="target a running gateway instead of spawning")
+    p.add_argument("--port", type=int, default=502)
+    p.add_argument("--tick", type=float, default=1.0, help="simulator tick")
+    args = p.parse_args()
+
+    records = read_capture(args.capture)
+    if not records:
+        print("empty capture")
+        return
+
+    if args.host:
+        stats = replay(records, args.host, args.port, args.speed)
+    else:
+        from server import WaterTreatmentPLC
+
+        plc_port, gate_port = free_port(), free_port()
+        plc = WaterTreatmentPLC(host="127.0.0.1", port=plc_port, tick=args.tick)
+        plc.start()
+        tmp = tempfile.mkdtemp(prefix="wt-replay-")
+        env = dict(
+            os.environ,
+            BACKEND_HOST="127.0.0.1",
+            BACKEND_PORT=str(plc_port),
+            GATE_PORT=str(gate_port),
+            FLAGS_DB_PATH=os.path.join(tmp, "flags.db"),
+            CAPTURE_PATH="",
+        )
+        gw = subprocess.Popen([sys.executable, str(HERE / "gateway.py")], env=env)
+        try:
+            wait_port(gate_port)
+            stats = replay(records, "127.0.0.1", gate_port, args.speed)
+        finally:
+            gw.terminate()
+            gw.wait(timeout=5)
+            plc.stop()
+
+    for k, v in stats.items():
+        print(f"{k:>15}: {v:.3f}" if isinstance(v, float) else f"{k:>15}: {v}")
+
+
+if __name__ == "__main__":
+    main()
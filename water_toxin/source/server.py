@@ -9,12 +9,17 @@ Addressing contract:
 
 import argparse
 import logging
+import mmap
 import signal
 import sys
 import time
 import threading
 import os
-from pyModbusTCP.server import ModbusServer
+import struct
+
+import numpy as np
+from pyModbusTCP.constants import EXP_GATEWAY_PATH_UNAVAILABLE
+from pyModbusTCP.server import DataBank, DataHandler, ModbusServer
 
 logging.basicConfig(
     level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s"
@@ -28,13 +33,340 @@ RO_START, RO_END = 200, 679  # 15 slots x 32 regs = 480 regs, inclusive
 SLOTS, SLOT_SIZE = 15, 32
 PTR_TABLE_BASE = 600
 
+# Vectorized tank farm (--tanks N). Coils: pump[N], intake[N], discharge[N]
+# from SIM_COIL_BASE. Holding registers: level[N], inflow[N], outflow[N] from
+# SIM_HR_BASE. Both blocks sit clear of the gateway's checker/pointer ranges.
+SIM_COIL_BASE = 1000
+SIM_HR_BASE = 1000
+SIM_MAX_TANKS = (65536 - SIM_HR_BASE) // 3
+LEVEL_MAX = 1000
+
+
+MIN_TICK = 0.001
+
+
+class TickScheduler:
+    """Fixed-rate ticks on the monotonic clock.
+
+    Deadlines are start + k * tick, so time spent in the tick body does not
+    accumulate as drift. When a tick overruns by a whole period, the missed
+    deadlines are counted and skipped instead of being replayed in a burst.
+    """
+
+    def __init__(self, tick, stop, stats_interval=10.0):
+        if tick < MIN_TICK:
+            raise ValueError(f"tick must be >= {MIN_TICK}s")
+        self.tick = tick
+        self.stop = stop
+        self.stats_interval = stats_interval
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.missed = 0
+        self.jitter_sum = 0.0
+        self.jitter_sq = 0.0
+        self.jitter_max = 0.0
+
+    def stats(self):
+        n = max(1, self.ticks)
+        mean = self.jitter_sum / n
+        std = max(0.0, self.jitter_sq / n - mean * mean) ** 0.5
+        return {
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "jitter_mean_ms": mean * 1000,
+            "jitter_std_ms": std * 1000,
+            "jitter_max_ms": self.jitter_max * 1000,
+        }
+
+    def run(self, body):
+        tick = self.tick
+        deadline = time.monotonic()
+        next_report = deadline + self.stats_interval
+        while not self.stop.is_set():
+            now = time.monotonic()
+            late = now - deadline
+            if late > 0:
+                self.ticks += 1
+                self.jitter_sum += late
+                self.jitter_sq += late * late
+                if late > self.jitter_max:
+                    self.jitter_max = late
+                body()
+                deadline += tick
+                now = time.monotonic()
+                if now - deadline >= tick:
+                    skipped = int((now - deadline) // tick)
+                    self.missed += skipped
+                    deadline += skipped * tick
+                if self.stats_interval and now >= next_report:
+                    self._report()
+                    next_report = now + self.stats_interval
+            elif -late > 0.01:
+                self.stop.wait(-late)  # coarse waits stay responsive to stop()
+            else:
+                time.sleep(-late)
+
+    def _report(self):
+        st = self.stats()
+        msg = (
+            f"[PLC] tick {self.tick * 1000:.1f}ms: {st['ticks']} ticks, "
+            f"{st['missed']} missed, jitter mean {st['jitter_mean_ms']:.3f}ms "
+            f"std {st['jitter_std_ms']:.3f}ms max {st['jitter_max_ms']:.3f}ms"
+        )
+        if st["missed"]:
+            logging.warning(msg)
+        else:
+            logging.info(msg)
+        self.reset_stats()
+
+
+class BlockDataBank(DataBank):
+    """DataBank with whole-block writes (one slice assignment under the lock)."""
+
+    def set_coils_block(self, address, bits):
+        with self._coils_lock:
+            self._coils[address : address + len(bits)] = bits
+
+    def set_holding_block(self, address, words):
+        with self._h_regs_lock:
+            self._h_regs[address : address + len(words)] = words
+
+    def get_image(self):
+        with self._coils_lock:
+            coils = np.array(self._coils, dtype=bool)
+        with self._h_regs_lock:
+            regs = np.array(self._h_regs, dtype=np.uint16)
+        return coils, regs
+
+    def set_image(self, coils, regs):
+        with self._coils_lock:
+            self._coils[:] = coils.astype(bool).tolist()
+        with self._h_regs_lock:
+            self._h_regs[:] = regs.astype(int).tolist()
+
+
+class Snapshot:
+    """Register image plus simulation state in a memory-mapped file.
+
+    Layout: HDR, packed coil bits, holding registers (uint16), then the tank
+    farm arrays (float64). `seq` is odd while a save is in progress, so a
+    torn image left by a crash is never restored.
+    """
+
+    MAGIC = b"WTSNAP1\0"
+    HDR = struct.Struct("<8sIIIIQd")
+    FARM_FIELDS = ("level", "in_rate", "out_rate", "low", "high")
+
+    def __init__(self, path, n_coils, n_regs, tanks):
+        self.path = path
+        self.n_coils = n_coils
+        self.n_regs = n_regs
+        self.tanks = tanks
+        self.coil_off = self.HDR.size
+        self.reg_off = self.coil_off + (n_coils + 7) // 8
+        self.farm_off = self.reg_off + n_regs * 2
+        self.size = self.farm_off + len(self.FARM_FIELDS) * tanks * 8
+        self.mm = None
+        self.seq = 0
+
+    def _map(self, create):
+        """Map the file; only a save may create or resize it."""
+        if self.mm is not None:
+            return True
+        try:
+            fd = os.open(self.path, os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+        except FileNotFoundError:
+            return False
+        try:
+            if os.fstat(fd).st_size != self.size:
+                if not create:
+                    logging.warning(
+                        f"[PLC] snapshot {self.path} size mismatch, ignoring"
+                    )
+                    return False
+                os.ftruncate(fd, self.size)
+            self.mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.seq = self._header()[5]
+        return True
+
+    def _header(self):
+        return self.HDR.unpack_from(self.mm, 0)
+
+    def _write_header(self, seq):
+        self.HDR.pack_into(
+            self.mm,
+            0,
+            self.MAGIC,
+            1,
+            self.n_coils,
+            self.n_regs,
+            self.tanks,
+            seq,
+            time.time(),
+        )
+
+    def save(self, db, farm):
+        self._map(create=True)
+        coils, regs = db.get_image()
+        self.seq += 1 if self.seq % 2 == 0 else 2
+        self._write_header(self.seq)
+        packed = np.packbits(coils)
+        self.mm[self.coil_off : self.coil_off + len(packed)] = packed.tobytes()
+        self.mm[self.reg_off : self.farm_off] = regs.astype("<u2").tobytes()
+        if farm:
+            view = np.frombuffer(
+                self.mm,
+                dtype="<f8",
+                count=len(self.FARM_FIELDS) * self.tanks,
+                offset=self.farm_off,
+            ).reshape(len(self.FARM_FIELDS), self.tanks)
+            for i, name in enumerate(self.FARM_FIELDS):
+                view[i] = getattr(farm, name)
+            del view
+        self.seq += 1
+        self._write_header(self.seq)
+        self.mm.flush()
+
+    def load(self, db, farm):
+        if not self._map(create=False):
+            return False
+        magic, version, n_coils, n_regs, tanks, seq, saved_at = self._header()
+        if (magic, version, n_coils, n_regs, tanks) != (
+            self.MAGIC,
+            1,
+            self.n_coils,
+            self.n_regs,
+            self.tanks,
+        ):
+            logging.warning(f"[PLC] snapshot {self.path} does not match, ignoring")
+            return False
+        if seq == 0 or seq % 2:
+            logging.warning(f"[PLC] snapshot {self.path} incomplete, ignoring")
+            return False
+        bits = np.frombuffer(
+            self.mm,
+            dtype=np.uint8,
+            count=self.reg_off - self.coil_off,
+            offset=self.coil_off,
+        )
+        coils = np.unpackbits(bits)[: self.n_coils]
+        regs = np.frombuffer(
+            self.mm, dtype="<u2", count=self.n_regs, offset=self.reg_off
+        )
+        db.set_image(coils, regs)
+        if farm:
+            view = np.frombuffer(
+                self.mm,
+                dtype="<f8",
+                count=len(self.FARM_FIELDS) * self.tanks,
+                offset=self.farm_off,
+            ).reshape(len(self.FARM_FIELDS), self.tanks)
+            for i, name in enumerate(self.FARM_FIELDS):
+                setattr(farm, name, view[i].copy())
+        del bits, regs
+        age = time.time() - saved_at
+        logging.info(f"[PLC] restored snapshot {self.path} ({age:.0f}s old)")
+        return True
+
+
+class TankFarm:
+    """N tanks with pump, intake and discharge valve, stepped as NumPy arrays.
+
+    Coils are the actuator commands; with `auto` a hysteresis controller also
+    drives intake/discharge so levels keep moving without a client.
+    """
+
+    def __init__(self, n, seed=0, auto=True):
+        if not 0 < n <= SIM_MAX_TANKS:
+            raise ValueError(f"tanks must be in 1..{SIM_MAX_TANKS}")
+        rng = np.random.default_rng(seed)
+        self.n = n
+        self.auto = auto
+        self.level = rng.uniform(200, 800, n)
+        self.in_rate = rng.uniform(3.0, 8.0, n)
+        self.out_rate = rng.uniform(2.0, 7.0, n)
+        self.low = rng.uniform(150, 300, n)
+        self.high = rng.uniform(700, 850, n)
+
+    def setup(self, db):
+        n = self.n
+        pump = [True] * n
+        intake = [True] * n
+        discharge = [False] * n
+        db.set_coils_block(SIM_COIL_BASE, pump + intake + discharge)
+        self._publish(db, np.zeros(n), np.zeros(n))
+
+    def step(self, db):
+        n = self.n
+        bits = db.get_coils(SIM_COIL_BASE, 3 * n)
+        c = np.array(bits, dtype=bool).reshape(3, n)
+        pump, intake, discharge = c[0], c[1], c[2]
+
+        inflow = self.in_rate * (pump & intake)
+        outflow = np.minimum(self.out_rate * discharge, self.level)
+        self.level = np.clip(self.level + inflow - outflow, 0, LEVEL_MAX)
+
+        if self.auto:
+            intake = np.where(self.level >= self.high, False, intake)
+            intake = np.where(self.level <= self.low, True, intake)
+            discharge = np.where(self.level >= self.high, True, discharge)
+            discharge = np.where(self.level <= self.low, False, discharge)
+            db.set_coils_block(
+                SIM_COIL_BASE + n, np.concatenate([intake, discharge]).tolist()
+            )
+
+        self._publish(db, inflow, outflow)
+
+    def _publish(self, db, inflow, outflow):
+        regs = np.concatenate([self.level, inflow * 10, outflow * 10])
+        db.set_holding_block(SIM_HR_BASE, regs.astype(np.uint16).tolist())
+
 
 class WaterTreatmentPLC:
-    def __init__(self, host="0.0.0.0", port=1502, tick=1.0):
+    def __init__(
+        self,
+        host="0.0.0.0",
+        port=1502,
+        tick=1.0,
+        tanks=0,
+        seed=0,
+        listen=True,
+        stats_interval=10.0,
+        snapshot_load=None,
+        snapshot_save=None,
+        snapshot_interval=5.0,
+    ):
         self.sim_thread = None
-        self.server = ModbusServer(host=host, port=port, no_block=True)
+        self.data_bank = BlockDataBank()
+        self.server = None
+        if listen:
+            self.server = ModbusServer(
+                host=host, port=port, no_block=True, data_bank=self.data_bank
+            )
         self.tick = tick
+        self.farm = TankFarm(tanks, seed=seed) if tanks else None
         self._stop = threading.Event()
+        self.scheduler = TickScheduler(tick, self._stop, stats_interval)
+        shape = (
+            len(self.data_bank._coils),
+            len(self.data_bank._h_regs),
+            self.farm.n if self.farm else 0,
+        )
+        # restoring from one image and saving to another keeps the source
+        # intact, so several runs can start from the same state
+        self.snapshot_in = Snapshot(snapshot_load, *shape) if snapshot_load else None
+        self.snapshot = None
+        if snapshot_save:
+            if snapshot_save == snapshot_load:
+                self.snapshot = self.snapshot_in
+            else:
+                self.snapshot = Snapshot(snapshot_save, *shape)
+        self.snapshot_interval = snapshot_interval
+        self._next_snapshot = 0.0
 
     def start(self):
         self._setup()
@@ -46,13 +378,20 @@ class WaterTreatmentPLC:
     def stop(self):
         logging.info("[*] Stopping PLC...")
         self._stop.set()
+        if self.sim_thread:
+            self.sim_thread.join(timeout=2)
+        try:
+            self.save_snapshot()
+        except Exception as e:
+            logging.warning(f"final snapshot failed: {e}")
         try:
-            self.server.stop()
+            if self.server:
+                self.server.stop()
         except Exception as e:
             logging.warning(f"stop() exception: {e}")
 
     def _setup(self):
-        db = self.server.data_bank
+        db = self.data_bank
         for a in range(0, 9):
             db.set_coils(a, [False])
         # Process registers 0..4 + heartbeat
@@ -70,32 +409,179 @@ class WaterTreatmentPLC:
         for i in range(SLOTS):
             db.set_holding_registers(PTR_TABLE_BASE + i, [0])
 
+        if self.farm:
+            self.farm.setup(db)
+
+        if self.snapshot_in:
+            self.snapshot_in.load(db, self.farm)
+        if self.snapshot:
+            self._next_snapshot = time.monotonic() + self.snapshot_interval
+
         logging.info("[PLC] setup complete (0-based)")
 
-    def _simulate(self):
-        db = self.server.data_bank
-        while not self._stop.is_set():
+    def save_snapshot(self):
+        if self.snapshot:
+            self.snapshot.save(self.data_bank, self.farm)
+
+    def step(self):
+        db = self.data_bank
+        coils = db.get_coils(0, 9) or [False] * 9
+        regs = db.get_holding_registers(0, 5) or [500, 72, 20, 100, 55]
+        tank = regs[0]
+        main_pump = coils[0]
+        intake = coils[2]
+        discharge = coils[3]
+
+        if main_pump and intake:
+            tank = min(1000, tank + 5)
+        if discharge:
+            tank = max(0, tank - 5)
+        db.set_holding_registers(0, [tank])
+
+        # heartbeat++
+        hb = db.get_holding_registers(REG_HEARTBEAT, 1)[0]
+        db.set_holding_registers(REG_HEARTBEAT, [(hb + 1) & 0xFFFF])
+
+        if self.farm:
+            self.farm.step(db)
+
+    def _step_safe(self):
+        try:
+            self.step()
+        except Exception as e:
+            logging.error(f"[PLC] simulate error: {e}")
+        if self.snapshot and time.monotonic() >= self._next_snapshot:
+            self._next_snapshot = time.monotonic() + self.snapshot_interval
             try:
-                coils = db.get_coils(0, 9) or [False] * 9
-                regs = db.get_holding_registers(0, 5) or [500, 72, 20, 100, 55]
-                tank = regs[0]
-                main_pump = coils[0]
-                intake = coils[2]
-                discharge = coils[3]
-
-                if main_pump and intake:
-                    tank = min(1000, tank + 5)
-                if discharge:
-                    tank = max(0, tank - 5)
-                db.set_holding_registers(0, [tank])
-
-                # heartbeat++
-                hb = db.get_holding_registers(REG_HEARTBEAT, 1)[0]
-                db.set_holding_registers(REG_HEARTBEAT, [(hb + 1) & 0xFFFF])
+                self.save_snapshot()
+            except Exception as e:
+                logging.error(f"[PLC] snapshot error: {e}")
+
+    def _simulate(self):
+        self.scheduler.run(self._step_safe)
+
+
+class UnitDataHandler(DataHandler):
+    """Routes requests on one listener to a per-unit-ID DataBank."""
+
+    def __init__(self, banks):
+        super().__init__()
+        self.handlers = {unit: DataHandler(bank) for unit, bank in banks.items()}
+
+    def _route(self, name, *args):
+        srv_info = args[-1]
+        hdl = self.handlers.get(srv_info.recv_frame.mbap.unit_id)
+        if hdl is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_PATH_UNAVAILABLE)
+        return getattr(hdl, name)(*args)
+
+    def read_coils(self, address, count, srv_info):
+        return self._route("read_coils", address, count, srv_info)
+
+    def write_coils(self, address, bits_l, srv_info):
+        return self._route("write_coils", address, bits_l, srv_info)
+
+    def read_d_inputs(self, address, count, srv_info):
+        return self._route("read_d_inputs", address, count, srv_info)
+
+    def read_h_regs(self, address, count, srv_info):
+        return self._route("read_h_regs", address, count, srv_info)
+
+    def write_h_regs(self, address, words_l, srv_info):
+        return self._route("write_h_regs", address, words_l, srv_info)
+
+    def read_i_regs(self, address, count, srv_info):
+        return self._route("read_i_regs", address, count, srv_info)
+
 
+class PLCFleet:
+    """N independent WaterTreatmentPLC images stepped by one simulation thread.
+
+    mode="ports": PLC i listens on port + i.
+    mode="units": one listener on `port`, PLC i answers unit ID i + 1.
+    """
+
+    def __init__(
+        self,
+        count,
+        host="0.0.0.0",
+        port=1502,
+        tick=1.0,
+        mode="ports",
+        tanks=0,
+        seed=0,
+        stats_interval=10.0,
+        snapshot_load=None,
+        snapshot_save=None,
+        snapshot_interval=5.0,
+    ):
+        if mode not in ("ports", "units"):
+            raise ValueError(f"unknown fleet mode: {mode}")
+        if mode == "units" and not 0 < count <= 247:
+            raise ValueError("unit-ID fleets are limited to 247 PLCs")
+        self.tick = tick
+        self.plcs = [
+            WaterTreatmentPLC(
+                host=host,
+                port=port + i,
+                tick=tick,
+                tanks=tanks,
+                seed=seed + i,
+                listen=(mode == "ports"),
+                stats_interval=0,
+                snapshot_load=f"{snapshot_load}.{i}" if snapshot_load else None,
+                snapshot_save=f"{snapshot_save}.{i}" if snapshot_save else None,
+                snapshot_interval=snapshot_interval,
+            )
+            for i in range(count)
+        ]
+        self.servers = [plc.server for plc in self.plcs if plc.server]
+        if mode == "units":
+            banks = {i + 1: plc.data_bank for i, plc in enumerate(self.plcs)}
+            self.servers = [
+                ModbusServer(
+                    host=host,
+                    port=port,
+                    no_block=True,
+                    data_hdl=UnitDataHandler(banks),
+                )
+            ]
+        self.sim_thread = None
+        self._stop = threading.Event()
+        self.scheduler = TickScheduler(tick, self._stop, stats_interval)
+
+    def start(self):
+        for plc in self.plcs:
+            plc._setup()
+        for srv in self.servers:
+            srv.start()
+        logging.info(
+            f"[+] fleet of {len(self.plcs)} PLCs on {len(self.servers)} port(s)"
+        )
+        self.sim_thread = threading.Thread(target=self._simulate, daemon=True)
+        self.sim_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.sim_thread:
+            self.sim_thread.join(timeout=2)
+        for plc in self.plcs:
+            try:
+                plc.save_snapshot()
+            except Exception as e:
+                logging.warning(f"final snapshot failed: {e}")
+        for srv in self.servers:
+            try:
+                srv.stop()
             except Exception as e:
-                logging.error(f"[PLC] simulate error: {e}")
-            time.sleep(self.tick)
+                logging.warning(f"stop() exception: {e}")
+
+    def _step_all(self):
+        for plc in self.plcs:
+            plc._step_safe()
+
+    def _simulate(self):
+        self.scheduler.run(self._step_all)
 
 
 def main():
@@ -104,10 +590,50 @@ def main():
     p.add_argument(
         "--port", type=int, default=int(os.environ.get("BACKEND_PORT", "1502"))
     )
-    p.add_argument("--tick", type=float, default=1.0)
+    p.add_argument("--tick", type=float, default=1.0, help=f"seconds, >= {MIN_TICK}")
+    p.add_argument(
+        "--stats-interval", type=float, default=10.0, help="tick stats log period"
+    )
+    p.add_argument("--tanks", type=int, default=0, help="vectorized tank farm size")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--snapshot", help="memory-mapped register image to restore/save")
+    p.add_argument(
+        "--snapshot-load", help="restore from this image (default --snapshot)"
+    )
+    p.add_argument("--snapshot-save", help="save to this image (default --snapshot)")
+    p.add_argument("--snapshot-interval", type=float, default=5.0)
+    p.add_argument("--fleet", type=int, default=0, help="number of simulated PLCs")
+    p.add_argument("--fleet-mode", choices=("ports", "units"), default="ports")
     args = p.parse_args()
+    snapshot_load = args.snapshot_load or args.snapshot
+    snapshot_save = args.snapshot_save or args.snapshot
 
-    plc = WaterTreatmentPLC(host=args.host, port=args.port, tick=args.tick)
+    if args.fleet:
+        plc = PLCFleet(
+            args.fleet,
+            host=args.host,
+            port=args.port,
+            tick=args.tick,
+            mode=args.fleet_mode,
+            tanks=args.tanks,
+            seed=args.seed,
+            stats_interval=args.stats_interval,
+            snapshot_load=snapshot_load,
+            snapshot_save=snapshot_save,
+            snapshot_interval=args.snapshot_interval,
+        )
+    else:
+        plc = WaterTreatmentPLC(
+            host=args.host,
+            port=args.port,
+            tick=args.tick,
+            tanks=args.tanks,
+            seed=args.seed,
+            stats_interval=args.stats_interval,
+            snapshot_load=snapshot_load,
+            snapshot_save=snapshot_save,
+            snapshot_interval=args.snapshot_interval,
+        )
 
     def _stop(*_):
         plc.stop()